@@ -1,22 +1,8 @@
-import time
-import random
-import pygame
+import smilebot_audio
 #say positive things every ten minutes
 #say positive things
-def sayPositiveThings():
-    #print("You are going to get your kip soon!")
-    #print(random.choice(positiveThings))
-    try:
-        pygame.mixer.init()
-        sound = pygame.mixer.Sound(random.choice(positiveThings))
-        sound.play()
-        # Wait for the sound to finish playing
-        while pygame.mixer.get_busy():
-            pygame.time.wait(100)
-    except Exception as e:
-        print(f"Error playing sound: {e}")
-
-
+# The player itself lives in smilebot_audio so the control server can run
+# it as a thread instead of starting this script as a second interpreter.
 
 #main program
 #positiveThings = ["You are going to get your kip soon!", "blah blah blah blah", "oogah shakah nah", "koalas are cute", "rorororrororo"]
@@ -38,8 +24,7 @@ for r in range(0, numberOfThings): # :)
 #     positiveThings.append(newThing)
 # print(positiveThings)
 
-while True:
-    #time.sleep(6000)
-    time.sleep(2)
-    sayPositiveThings()
-
+#time.sleep(6000)
+player = smilebot_audio.AudioService(positiveThings, chatter_interval=2)
+player.start()
+player.join()
@@ -0,0 +1,223 @@
+"""Benchmark how the fleet scheduler scales with the number of drive units.
+
+For each unit count this builds a smilebot_fleet.Fleet in process, drives
+every unit with a random walk on the stick at --rate commands a second
+(staggered so they don't all land at once, and busy enough that every unit
+keeps ramping), and reports as JSON:
+
+    steps_per_s         unit steps run by the scheduler
+    pickup_ms           command publish to the step that picks it up,
+                        p50/p99/max
+    step_lateness_ms    slew step wake up after its deadline, mean/max,
+                        and steps missed outright (overruns)
+    cpu_percent         the scheduler thread(s), and the whole process
+
+--mode threads runs each unit on its own thread instead, the way N copies
+of core.motor_control_loop would, for comparison. Motors are no-op stand
+ins unless --motors mock, which puts gpiozero's mock pins behind the
+first four units (there are only enough GPIOs for four).
+
+    python3 bench_fleet.py --units 1,4,16,64 --seconds 5 --output fleet.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import bench_server
+import smilebot_config
+import smilebot_core as core
+import smilebot_fleet
+
+# BCM pins handed out six to a unit with --motors mock
+MOCK_PINS = [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22,
+             23, 24, 25, 26, 27]
+
+class NullMotor:
+    # gpiozero.Motor's interface doing nothing, to time the scheduler alone
+
+    def forward(self, speed=1):
+        pass
+
+    def backward(self, speed=1):
+        pass
+
+    def stop(self):
+        pass
+
+class TimedUnit(smilebot_fleet.DriveUnit):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pickups = []
+
+    def step(self, now, armed, command):
+        if command.seq != self.picked_seq:
+            self.pickups.append(now - command.received)
+        return super().step(now, armed, command)
+
+def make_units(count, motors):
+    units = []
+    for i in range(count):
+        pins = dict(forward=0, backward=0, enable=0)
+        unit = TimedUnit('unit%d' % i, pins, pins)
+        if motors == 'mock':
+            from gpiozero import Motor
+            pins = MOCK_PINS[i * 6:i * 6 + 6]
+            unit.left_motor = Motor(**dict(zip(smilebot_config.PIN_NAMES, pins[:3])))
+            unit.right_motor = Motor(**dict(zip(smilebot_config.PIN_NAMES, pins[3:])))
+        else:
+            unit.left_motor = unit.right_motor = NullMotor()
+        units.append(unit)
+    return units
+
+def thread_cpu_seconds(tid):
+    # As bench_server.read_cpu_seconds, for one thread of this process
+    with open('/proc/self/task/%d/stat' % tid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def run_threaded(fleet, tids):
+    # One loop per unit, each with its own wake event, like core.motor_control_loop
+    threads = []
+    for unit in fleet.units.values():
+        wake = threading.Event()
+        unit.notify = lambda unit, wake=wake: wake.set()
+
+        def loop(unit=unit, wake=wake):
+            tids.append(threading.get_native_id())
+            while fleet.running:
+                wake.clear()
+                due = unit.step(fleet.clock(), unit.armed, unit.command)
+                wake.wait(max(0.0, due - fleet.clock()))
+        threads.append(threading.Thread(target=loop, daemon=True))
+    for thread in threads:
+        thread.start()
+    return threads
+
+def drive(units, rate, seconds, seed=0):
+    # Random walk commands for every unit, staggered across each period
+    rng = random.Random(seed)
+    sticks = [[0.0, 0.0] for _ in units]
+    interval = 1.0 / (rate * len(units))
+    start = time.monotonic()
+    next_send = start
+    sent = 0
+    while next_send < start + seconds:
+        delay = next_send - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        i = sent % len(units)
+        stick = sticks[i]
+        stick[0] = max(-1.0, min(1.0, stick[0] + rng.uniform(-0.4, 0.4)))
+        stick[1] = max(-1.0, min(1.0, stick[1] + rng.uniform(-0.4, 0.4)))
+        units[i].set_joystick(stick[0], stick[1])
+        sent += 1
+        next_send += interval
+    return sent, time.monotonic() - start
+
+def ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+def run_case(count, mode, rate, seconds, motors):
+    units = make_units(count, motors)
+    fleet = smilebot_fleet.Fleet(units)
+    tids = []
+    if mode == 'scheduler':
+        def scheduler():
+            tids.append(threading.get_native_id())
+            fleet.run()
+        threads = [threading.Thread(target=scheduler, daemon=True)]
+        threads[0].start()
+    else:
+        threads = run_threaded(fleet, tids)
+    while len(tids) < len(threads):
+        time.sleep(0.01)
+    for unit in units:
+        unit.set_armed(True)
+    time.sleep(0.2)
+    for unit in units:
+        unit.pickups.clear()
+    steps_before = sum(unit.stats.iterations for unit in units)
+    cpu_before = sum(thread_cpu_seconds(tid) for tid in tids)
+    process_before = time.process_time()
+    sent, elapsed = drive(units, rate, seconds)
+    cpu = sum(thread_cpu_seconds(tid) for tid in tids) - cpu_before
+    process = time.process_time() - process_before
+    steps = sum(unit.stats.iterations for unit in units) - steps_before
+    fleet.stop()
+    for unit in units:
+        unit.notify(unit)  # wake whichever loop is waiting on it
+    for thread in threads:
+        thread.join(timeout=2.0)
+    if motors == 'mock':
+        for unit in units:
+            unit.left_motor.close()
+            unit.right_motor.close()
+
+    pickups = sorted(p for unit in units for p in unit.pickups)
+    lateness_steps = sum(unit.stats.steps for unit in units)
+    return {
+        'units': count,
+        'mode': mode,
+        'motors': motors,
+        'commands_per_s': round(sent / elapsed, 1),
+        'steps_per_s': round(steps / elapsed, 1),
+        'pickup_ms': {'count': len(pickups),
+                      'p50': ms(bench_server.percentile(pickups, 0.50)),
+                      'p99': ms(bench_server.percentile(pickups, 0.99)),
+                      'max': ms(pickups[-1] if pickups else None)},
+        'step_lateness_ms': {
+            'mean': ms(sum(unit.stats.lateness_sum for unit in units) / lateness_steps
+                       if lateness_steps else None),
+            'max': ms(max(unit.stats.lateness_max for unit in units)),
+            'overruns': sum(unit.stats.overruns for unit in units),
+        },
+        'cpu_percent': {'loop': round(100 * cpu / elapsed, 1),
+                        'process': round(100 * process / elapsed, 1)},
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--units', default='1,4,16,64', help="comma separated unit counts")
+    parser.add_argument('--mode', default='scheduler', help="comma separated, of scheduler, threads")
+    parser.add_argument('--rate', type=float, default=50.0, help="commands per second per unit")
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--motor-rate', type=float, default=core.MOTOR_RATE_HZ,
+                        help="step rate in Hz while a unit's outputs are ramping")
+    parser.add_argument('--motors', choices=('null', 'mock'), default='null')
+    parser.add_argument('--output', help="write JSON here as well as to stdout")
+    args = parser.parse_args()
+    try:
+        core.MOTOR_RATE_HZ = core.check_motor_rate(args.motor_rate)
+    except ValueError as e:
+        parser.error(str(e))
+    counts = [int(v) for v in args.units.split(',') if v]
+    modes = [v for v in args.mode.split(',') if v]
+    for mode in modes:
+        if mode not in ('scheduler', 'threads'):
+            parser.error('unknown mode %r' % mode)
+    if args.motors == 'mock' and max(counts) * 6 > len(MOCK_PINS):
+        parser.error('--motors mock has pins for at most %d units' % (len(MOCK_PINS) // 6))
+    runs = []
+    for count in counts:
+        for mode in modes:
+            print('%s units=%d' % (mode, count), file=sys.stderr)
+            runs.append(run_case(count, mode, args.rate, args.seconds, args.motors))
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {'machine': platform.machine(), 'python': platform.python_version(),
+                 'cpus': os.cpu_count()},
+        'seconds': args.seconds,
+        'rate': args.rate,
+        'motor_rate_hz': args.motor_rate,
+        'runs': runs,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
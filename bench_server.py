@@ -0,0 +1,130 @@
+"""Load test a running control server, to compare server modes.
+
+Start a server (smilebot_control_v3.py or smilebot_control_async.py, on
+mock pins off the Pi), then point this at it:
+
+    GPIOZERO_PIN_FACTORY=mock GPIOZERO_MOCK_PIN_CLASS=mockpwmpin \\
+        python3 smilebot_control_async.py &
+    python3 bench_server.py --pid $! --clients 8 --seconds 10
+
+Each client thread keeps one HTTP/1.1 connection open and POSTs /joystick
+as fast as it can (or at --rate per client). Reports requests per second,
+latency percentiles and, with --pid, the server's RSS, thread count and
+CPU time over the run.
+"""
+import argparse
+import http.client
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+def read_proc_status(pid):
+    status = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            status[key] = value.strip()
+    return status
+
+def read_cpu_seconds(pid):
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are fields 14 and 15, counted from the pid
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def client(url, path, rate, deadline, client_id, latencies, errors):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=5)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    interval = 1.0 / rate if rate else 0.0
+    next_send = time.monotonic()
+    sent = 0
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        if interval:
+            if now < next_send:
+                time.sleep(next_send - now)
+            next_send += interval
+        sent += 1
+        # Sequence numbers follow send time, like one page with many
+        # fingers, so the server accepts whichever request is newest
+        seq = time.time_ns() // 1000 * 64 + client_id % 64
+        throttle = (sent % 200) / 100.0 - 1.0
+        body = urlencode({'throttle': throttle, 'steering': 0.0, 'seq': seq})
+        start = time.perf_counter()
+        try:
+            conn.request('POST', path, body, headers)
+            conn.getresponse().read()
+        except (OSError, http.client.HTTPException):
+            errors.append(time.monotonic())
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=5)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+def run(url, path='/joystick', clients=8, seconds=10.0, rate=0.0, pid=None):
+    latencies = []
+    errors = []
+    rss_start = read_proc_status(pid)['VmRSS'] if pid else None
+    cpu_start = read_cpu_seconds(pid) if pid else None
+    start = time.monotonic()
+    deadline = start + seconds
+    threads = [threading.Thread(target=client,
+                                args=(url, path, rate, deadline, i, latencies, errors))
+               for i in range(clients)]
+    peak_threads = 0
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        if pid:
+            peak_threads = max(peak_threads, int(read_proc_status(pid)['Threads']))
+        time.sleep(0.1)
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    result = {
+        'url': url + path,
+        'clients': clients,
+        'seconds': round(elapsed, 3),
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+            'p90': round(percentile(latencies, 0.9) * 1000, 3) if latencies else None,
+            'p99': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+            'max': round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+    }
+    if pid:
+        status = read_proc_status(pid)
+        result['server'] = {
+            'rss_start': rss_start,
+            'rss_end': status['VmRSS'],
+            'rss_peak': status['VmHWM'],
+            'threads_peak': peak_threads,
+            'cpu_seconds': round(read_cpu_seconds(pid) - cpu_start, 3),
+        }
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--path', default='/joystick')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='requests per second per client, 0 for flat out')
+    parser.add_argument('--pid', type=int, help='server pid for RSS/CPU/thread stats')
+    args = parser.parse_args()
+    print(json.dumps(run(args.url, args.path, args.clients, args.seconds, args.rate, args.pid),
+                     indent=2))
@@ -0,0 +1,197 @@
+"""Benchmark the control servers and motor loop, results as JSON.
+
+For every combination of server mode, motor loop rate, client count and
+client rate this starts a fresh server on gpiozero's mock pins with
+SMILEBOT_METRICS=1, drives /joystick with bench_server's synthetic
+clients, then reads /metrics before and after to work out:
+
+    rps and HTTP latency        from the clients
+    command_to_motor_ms         command publish to motor write done, p50/p99
+    motor_writes_per_s          gpiozero writes over the run
+    loop                        slew step lateness p50/p99/max, overruns,
+                                longest gap between loop passes
+    server                      CPU seconds (motor process included), RSS
+
+    python3 bench_suite.py --modes v3,v3-process,async --clients 1,8 \\
+        --rates 0,50 --seconds 5 --output bench.json
+
+Loop side numbers come from the server's own process, so with
+v3-process only the shared memory loop stats are available.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import bench_server
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODES = {
+    'v3': ['smilebot_control_v3.py'],
+    'v3-process': ['smilebot_control_v3.py', '--motor-process'],
+    'async': ['smilebot_control_async.py'],
+}
+# Modes that take --motor-rate, the others always run the default
+RATE_MODES = ('v3', 'v3-process')
+
+def start_server(mode, port, motor_rate=None, log=subprocess.DEVNULL):
+    argv = [sys.executable] + [os.path.join(BASE_DIR, MODES[mode][0])] + MODES[mode][1:]
+    argv += ['--port', str(port)]
+    if motor_rate and mode in RATE_MODES:
+        argv += ['--motor-rate', str(motor_rate)]
+    env = dict(os.environ, GPIOZERO_PIN_FACTORY='mock', GPIOZERO_MOCK_PIN_CLASS='mockpwmpin',
+               SMILEBOT_METRICS='1', SDL_AUDIODRIVER='dummy')
+    return subprocess.Popen(argv, env=env, cwd=BASE_DIR, stdout=log, stderr=log)
+
+def request(port, method, path, body=None, timeout=5):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+def wait_ready(proc, port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('server exited with %d' % proc.returncode)
+        try:
+            if request(port, 'GET', '/', timeout=1)[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('server not ready after %g s' % timeout)
+
+def stop_server(proc, port):
+    try:
+        request(port, 'POST', '/shutdown', timeout=2)
+    except (OSError, http.client.HTTPException):
+        pass  # the server exits mid-request
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def read_metrics(port):
+    return json.loads(request(port, 'GET', '/metrics?format=json')[1])['metrics']
+
+def process_tree(pid):
+    # pid and its children, for the motor process
+    pids = [pid]
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+def tree_cpu_seconds(pids):
+    total = 0.0
+    for pid in pids:
+        try:
+            total += bench_server.read_cpu_seconds(pid)
+        except OSError:
+            pass
+    return total
+
+def ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+def run_case(mode, clients, rate, seconds, motor_rate, port):
+    proc = start_server(mode, port, motor_rate)
+    try:
+        wait_ready(proc, port)
+        request(port, 'POST', '/arm', 'state=true')
+        pids = process_tree(proc.pid)
+        before = read_metrics(port)
+        cpu_start = tree_cpu_seconds(pids)
+        load = bench_server.run('http://127.0.0.1:%d' % port, '/joystick', clients, seconds,
+                                rate, proc.pid)
+        cpu = tree_cpu_seconds(pids) - cpu_start
+        after = read_metrics(port)
+    finally:
+        stop_server(proc, port)
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    command = after.get('smilebot_command_to_write_seconds', {})
+    lateness = after.get('smilebot_loop_step_lateness_seconds', {})
+    server = load.pop('server', {})
+    server['cpu_seconds'] = round(cpu, 3)
+    server['cpu_percent'] = round(100 * cpu / load['seconds'], 1)
+    server['processes'] = len(pids)
+    return {
+        'mode': mode,
+        'motor_rate_hz': motor_rate if mode in RATE_MODES else None,
+        'clients': clients,
+        'client_rate': rate,
+        'load': load,
+        'command_to_motor_ms': {
+            'count': command.get('count', 0) - before.get('smilebot_command_to_write_seconds', {}).get('count', 0),
+            'p50': ms(command.get('p50')),
+            'p99': ms(command.get('p99')),
+            'max': ms(command.get('max')),
+        },
+        'motor_writes_per_s': round(delta('smilebot_motor_writes_total') / load['seconds'], 1),
+        'loop': {
+            'iterations_per_s': round(delta('smilebot_loop_iterations') / load['seconds'], 1),
+            'step_lateness_ms': {'p50': ms(lateness.get('p50')), 'p99': ms(lateness.get('p99')),
+                                 'max': ms(lateness.get('max'))},
+            'overruns': delta('smilebot_loop_overruns'),
+            'period_max_ms': ms(after.get('smilebot_loop_period_max')),
+            'pickup_max_ms': ms(after.get('smilebot_loop_pickup_max')),
+        },
+        'server': server,
+    }
+
+def split_list(text, kind):
+    return [kind(v) for v in text.split(',') if v]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modes', default='v3,async', help="comma separated, of %s" % ', '.join(MODES))
+    parser.add_argument('--clients', default='1,8', help="comma separated client counts")
+    parser.add_argument('--rates', default='0', help="comma separated per client rates, 0 for flat out")
+    parser.add_argument('--motor-rates', default='', help="comma separated motor loop rates in Hz")
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--output', help="write JSON here as well as to stdout")
+    args = parser.parse_args()
+
+    modes = split_list(args.modes, str)
+    for mode in modes:
+        if mode not in MODES:
+            parser.error('unknown mode %r' % mode)
+    runs = []
+    for mode, clients, rate, motor_rate in itertools.product(
+            modes, split_list(args.clients, int), split_list(args.rates, float),
+            split_list(args.motor_rates, float) or [None]):
+        if motor_rate and mode not in RATE_MODES and runs and runs[-1]['mode'] == mode \
+                and runs[-1]['clients'] == clients and runs[-1]['client_rate'] == rate:
+            continue  # motor rate is fixed in this mode, one run is enough
+        print('%s clients=%d rate=%g motor_rate=%s' % (mode, clients, rate, motor_rate),
+              file=sys.stderr)
+        runs.append(run_case(mode, clients, rate, args.seconds, motor_rate, args.port))
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {'machine': platform.machine(), 'python': platform.python_version(),
+                 'cpus': os.cpu_count()},
+        'seconds': args.seconds,
+        'runs': runs,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
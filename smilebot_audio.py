@@ -0,0 +1,174 @@
+"""Clip player that runs as a thread inside the control server.
+
+AudioService owns the pygame mixer and a ClipCache of decoded clips, and
+plays whatever is put on its request queue, one clip after another. It
+knows when a clip ends from the clip length, so it sleeps until then
+instead of polling pygame.mixer.get_busy(), leaving new requests on the
+bounded queue meanwhile. pygame is only imported once the service starts.
+"""
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+
+CLIP_DIR = os.path.dirname(os.path.abspath(__file__))
+NUMBER_OF_CLIPS = 3
+
+# Decoded clips, least recently played first. Decoding an MP3 is the slow
+# part of playing one, so each clip is decoded once and kept until the
+# memory budget forces it out.
+CLIP_CACHE_BUDGET = 32 * 1024 * 1024  # bytes of decoded PCM
+MAX_QUEUED_CLIPS = 8
+
+_STOP = object()
+_RECONFIGURE = object()
+
+def clip_paths(count=NUMBER_OF_CLIPS):
+    return [os.path.join(CLIP_DIR, "thing" + str(r) + ".mp3") for r in range(count)]
+
+def resolve_clip(path):
+    # Clip names are relative to the repo, not to wherever we were started
+    return path if os.path.isabs(path) else os.path.join(CLIP_DIR, path)
+
+def decoded_size(sound):
+    # PCM bytes held by a Sound, from the mixer format rather than get_raw()
+    # which would copy the whole buffer
+    import pygame
+    frequency, sample_format, channels = pygame.mixer.get_init()
+    return int(sound.get_length() * frequency * channels * (abs(sample_format) // 8))
+
+class ClipCache:
+    def __init__(self, budget=CLIP_CACHE_BUDGET):
+        self.budget = budget
+        self.used = 0
+        self.clips = OrderedDict()  # path -> (Sound, size in bytes)
+
+    def get(self, path):
+        import pygame
+        entry = self.clips.get(path)
+        if entry is not None:
+            self.clips.move_to_end(path)
+            return entry[0]
+        sound = pygame.mixer.Sound(path)
+        size = decoded_size(sound)
+        # Never evict the clip we are about to play, even if it alone is over budget
+        while self.clips and self.used + size > self.budget:
+            _, (_, evicted_size) = self.clips.popitem(last=False)
+            self.used -= evicted_size
+        self.clips[path] = (sound, size)
+        self.used += size
+        return sound
+
+    def preload(self, paths):
+        # Fill up to the budget without evicting anything already loaded
+        import pygame
+        for path in paths:
+            if path in self.clips:
+                continue
+            try:
+                sound = pygame.mixer.Sound(path)
+            except Exception as e:
+                print(f"Error loading {path}: {e}")
+                continue
+            size = decoded_size(sound)
+            if self.used + size > self.budget:
+                break
+            self.clips[path] = (sound, size)
+            self.used += size
+
+class AudioService(threading.Thread):
+    # say() queues a clip (a random one by default) and returns at once.
+    # With chatter_interval set, a random clip is also played that many
+    # seconds after the last one finished, like beautiful-olive-sam.py.
+
+    def __init__(self, clips=None, chatter_interval=None, budget=CLIP_CACHE_BUDGET, preload=True):
+        super().__init__(name='audio', daemon=True)
+        self.clips = [resolve_clip(c) for c in clips] if clips is not None else clip_paths()
+        self.chatter_interval = chatter_interval
+        self.cache = ClipCache(budget)
+        self.preload = preload
+        # Requests stay here while a clip plays, so a full queue is what
+        # makes say() refuse
+        self.requests = queue.Queue(MAX_QUEUED_CLIPS)
+        self.stopped = threading.Event()
+
+    def say(self, clip=None):
+        # Returns False if the queue is full, a robot that talks over
+        # itself is worse than one that skips a line
+        try:
+            self.requests.put_nowait(clip)
+        except queue.Full:
+            return False
+        return True
+
+    def configure(self, clips, chatter_interval):
+        # Swaps in a new clip list and chatter interval while running. New
+        # clips are decoded the first time they play.
+        self.clips = [resolve_clip(c) for c in clips]
+        self.chatter_interval = chatter_interval
+        try:
+            self.requests.put_nowait(_RECONFIGURE)  # reschedule the chatter
+        except queue.Full:
+            pass  # busy, it reschedules after the next clip anyway
+
+    def knows(self, clip):
+        return resolve_clip(clip) in self.clips
+
+    def stop(self):
+        self.stopped.set()  # seen mid-clip, when the queue may be full
+        try:
+            self.requests.put_nowait(_STOP)  # wakes the player if idle
+        except queue.Full:
+            pass
+
+    def play(self, clip):
+        # Returns when the clip will have finished
+        path = resolve_clip(clip) if clip is not None else random.choice(self.clips)
+        sound = self.cache.get(path)
+        sound.play()
+        return time.monotonic() + sound.get_length()
+
+    def run(self):
+        try:
+            import pygame
+            pygame.mixer.init()
+        except Exception as e:
+            print(f"Audio disabled: {e}")
+            return
+        if self.preload:
+            self.cache.preload(self.clips)
+        playing_until = None
+        next_chatter = None
+        if self.chatter_interval is not None:
+            next_chatter = time.monotonic() + self.chatter_interval
+        while True:
+            if playing_until is not None:
+                # Leave requests queued until the clip ends
+                if self.stopped.wait(max(0.0, playing_until - time.monotonic())):
+                    break
+                playing_until = None
+                if self.chatter_interval is not None:
+                    next_chatter = time.monotonic() + self.chatter_interval
+                continue
+            # Idle: sleep until the next chatter is due or a request arrives
+            timeout = None if next_chatter is None else max(0.0, next_chatter - time.monotonic())
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                item = None  # chatter, a random clip
+            if item is _STOP or self.stopped.is_set():
+                break
+            if item is _RECONFIGURE:
+                next_chatter = (None if self.chatter_interval is None
+                                else time.monotonic() + self.chatter_interval)
+                continue
+            next_chatter = None
+            try:
+                playing_until = self.play(item)
+            except Exception as e:
+                print(f"Error playing sound: {e}")
+                if self.chatter_interval is not None:
+                    next_chatter = time.monotonic() + self.chatter_interval
+        pygame.mixer.quit()
@@ -1,81 +1,122 @@
-from gpiozero import Motor
-import time
+import argparse
+import sys
+import smilebot_core as core
+import smilebot_odometry
+from smilebot_motion import MotionEngine, MotionError, Segment, parse_program, parse_segment
+
+# (left, right) wheel speed per unit of power for each command, in
+# smilebot_core's pin convention. This script used to wire the left motor
+# as forward=22/backward=23, the reverse of the servers, so its left wheel
+# signs are flipped here to keep every move turning the wheels as before.
+WHEELS = {
+    'w': (-1, -1),
+    's': (1, 1),
+    'a': (1, -1),
+    'd': (-1, 1),
+}
 
-right_motor = Motor(forward=17, backward=27, enable=12)
-left_motor = Motor(forward=22, backward=23, enable=13)
 def stop():
-    left_motor.stop()
-    right_motor.stop()
+    core.drive_wheels(0, 0)
+
+def drive(command, power):
+    '''sets the motors for one motion command, returns straight away'''
+    left, right = WHEELS.get(command, (0, 0))
+    core.drive_wheels(left * power, right * power)
+
+engine = MotionEngine(drive)
 
 def move_forward(t, power):
     '''drives car forward for t seconds at specified power percentage'''
-    left_motor.forward(power)
-    right_motor.backward(power)
-    time.sleep(t)
-    stop()
+    engine.run([Segment('w', t, power, None)])
 
 def move_backward(t, power):
-    '''drives car forward for t seconds at specified power percentage'''
-    left_motor.backward(power)
-    right_motor.forward(power)
-    time.sleep(t)
-    stop()
+    '''drives car backward for t seconds at specified power percentage'''
+    engine.run([Segment('s', t, power, None)])
 
 def turn_left(t, power):
     '''turns car left for t seconds at specified power percentage'''
-    left_motor.backward(power)
-    right_motor.backward(power)
-    time.sleep(t)
-    stop()
+    engine.run([Segment('a', t, power, None)])
 
 def turn_right(t, power):
     '''turns car right for t seconds at specified power percentage'''
-    left_motor.forward(power)
-    right_motor.forward(power)
-    time.sleep(t)
-    stop()
+    engine.run([Segment('d', t, power, None)])
 
 def test(t, power):
-    move_forward(t, power)
-    move_backward(t, power)
-    turn_left(t, power)
-    turn_right(t, power)
-    stop()
+    engine.run([Segment(k, t, power, None) for k in 'wsad'])
     print("test completed")
 
-print("RC Car Control Ready. Enter W,A,D to control. Enter corresponding times and power percentages after commands. Enter Q to quit. Enter T to test. Remember to put spaces between commands/times/power or the code will break.")
+def print_pose():
+    '''prints where dead reckoning puts the car since it started'''
+    pose = smilebot_odometry.pose_dict(core.current_pose())
+    print("Pose: x %(x).2f m, y %(y).2f m, heading %(heading).0f deg, %(distance).2f m driven" % pose)
 
-while True:
+def read_batch():
+    '''asks for one batch of commands, returns (segments, quit)'''
     kcmds = input("Enter command(s): ").lower()
     tcmds = input("Enter time(s): ")
     pcmds = input("Enter power percentage(s) (0-100): ")
     klst = kcmds.split()
-    tlst = [float(t) for t in tcmds.split()]
-    plst = [float(p) / 100.0 for p in pcmds.split()]  # Convert power to a scale of 0 to 1
-    
+    tlst = tcmds.split()
+    plst = pcmds.split()
+    if len(tlst) < len(klst) or len(plst) < len(klst):
+        raise IndexError
+    segments = []
+    for k, t, p in zip(klst, tlst, plst):
+        if k == 'q':
+            return segments, True
+        for key in ('wsad' if k == 't' else k):
+            segments.append(parse_segment("%s %s %s" % (key, t, p)))
+    return segments, False
+
+def interactive():
+    print("RC Car Control Ready. Enter W,A,S,D to control, X to stop. Enter corresponding times and power percentages after commands. Enter Q to quit. Enter T to test. Remember to put spaces between commands/times/power or the code will break.")
+    while True:
+        try:
+            segments, quit = read_batch()
+        except IndexError:
+            print("Error: Number of commands, times, and power percentages do not match.")
+            continue
+        except MotionError as e:
+            print(f"Error: {e}")
+            continue
+        try:
+            # The whole batch runs as one timeline, each step starting the
+            # moment the last one ends
+            engine.run(segments)
+        except KeyboardInterrupt:
+            print("\nAborted.")
+        print_pose()
+        if quit:
+            break
+    stop()
+    print("RC Car Control stopped.")
+
+def run_script(path):
+    '''runs a motion program from a file, or streams it from stdin for -'''
+    if path == '-':
+        return engine.run_stream(sys.stdin)
+    with open(path) as f:
+        segments = parse_program(f)
+    return engine.run(segments)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drive the RC car from the terminal")
+    parser.add_argument('--script', metavar='FILE',
+                        help="run a motion program (see smilebot_motion.py), '-' streams it from stdin")
+    args = parser.parse_args()
+    core.init_motors()
     try:
-        for i in range(len(klst)):
-            if klst[i] == 'w':
-                move_forward(tlst[i], plst[i])
-            elif klst[i] == 'a':
-                turn_left(tlst[i], plst[i])
-            elif klst[i] == 's':
-                move_backward(tlst[i], plst[i])
-            elif klst[i] == 'd':
-                turn_right(tlst[i], plst[i])
-            elif klst[i] == "t":
-                test(tlst[i], plst[i])
-            elif klst[i] == 'q':
-                stop()
-                print("RC Car Control stopped.")
-                exit()
-            else:
-                stop()
-    except IndexError:
-        print("Error: Number of commands, times, and power percentages do not match.")
-    except ValueError:
-        print("Error: Invalid input. Please enter numeric values for times and power percentages.")
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-    
-    time.sleep(0.1)  # Short delay to prevent overwhelming the system
+        core.report_startup('smilebot_cli')
+        if args.script:
+            try:
+                finished = run_script(args.script)
+            except MotionError as e:
+                sys.exit(f"Error: {e}")
+            print("Program completed." if finished else "Program aborted.")
+            print_pose()
+        else:
+            interactive()
+    except (KeyboardInterrupt, EOFError):
+        print("\nRC Car Control stopped.")
+    finally:
+        stop()
@@ -0,0 +1,287 @@
+"""Runtime config file, watched and applied without restarting the server.
+
+    python3 smilebot_control_v3.py --config smilebot.json
+
+    {"shaping": {"throttle": {"dead_zone": 0.15, "expo": 0.3}},
+     "motor": {"rate_hz": 200, "left_slew_rate": 4.0, "right_slew_rate": 4.0,
+               "keepalive": 1.0},
+     "pins": {"left": {"forward": 23, "backward": 22, "enable": 13},
+              "right": {"forward": 17, "backward": 27, "enable": 12}},
+     "audio": {"clips": 3, "chatter_interval": 2}}
+
+Every section and key is optional; anything left out falls back to what
+the server started with. audio.clips is a count of thingN.mp3 files, as
+numberOfThings was, or a list of file names.
+
+Saving the file triggers a reload through inotify, with no polling (on
+systems without inotify the file's mtime is checked every POLL_INTERVAL
+instead). The whole file is validated before anything changes, so a typo
+leaves the running settings alone. Then, in order:
+
+    pins     disarm, and the motor loop moves the motors to the new pins
+             between passes; if claiming them fails it reclaims the old
+             ones and nothing else is applied
+    shaping  compiled tables swapped in whole, see core.set_shaping
+    motor    picked up by the motor loop at its next pass
+    audio    new clip list and chatter interval for the running player
+
+Only sections that changed are touched. Under --motor-process the motor
+loop runs in another process, so pin and motor changes are refused there
+until a restart; shaping still applies to the sticks.
+"""
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import threading
+import smilebot_audio
+import smilebot_core as core
+import smilebot_metrics as metrics
+import smilebot_shaping
+
+PIN_NAMES = ('forward', 'backward', 'enable')
+MOTOR_LIMITS = {'rate_hz': (core.MIN_MOTOR_RATE_HZ, core.MAX_MOTOR_RATE_HZ), 'left_slew_rate': (0.1, 100.0),
+                'right_slew_rate': (0.1, 100.0), 'keepalive': (0.05, 10.0)}
+MAX_CLIPS = 100
+DEBOUNCE = 0.2  # seconds of quiet after a change before reloading, editors write in bursts
+POLL_INTERVAL = 1.0  # without inotify
+
+reloads = metrics.counter('smilebot_config_reloads_total', 'Config file changes applied')
+reload_errors = metrics.counter('smilebot_config_errors_total', 'Config file changes rejected')
+
+def check_pins(pins, where):
+    if not isinstance(pins, dict) or set(pins) != set(PIN_NAMES):
+        raise ValueError('%s needs exactly %s' % (where, ', '.join(PIN_NAMES)))
+    for name, pin in pins.items():
+        if isinstance(pin, bool) or not isinstance(pin, int) or pin < 0:
+            raise ValueError('%s.%s must be a GPIO number' % (where, name))
+    return dict(pins)
+
+def check_number(value, low, high, where):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high:
+        raise ValueError('%s must be a number from %g to %g' % (where, low, high))
+    return float(value)
+
+def current_settings(audio=None):
+    # What is running now, in config file form
+    settings = {
+        'shaping': core.shaping.config,
+        'motor': {'rate_hz': float(core.MOTOR_RATE_HZ), 'left_slew_rate': core.LEFT_SLEW_RATE,
+                  'right_slew_rate': core.RIGHT_SLEW_RATE, 'keepalive': core.MOTOR_KEEPALIVE_INTERVAL},
+        'pins': {'left': dict(core.LEFT_MOTOR_PINS), 'right': dict(core.RIGHT_MOTOR_PINS)},
+    }
+    if audio is not None:
+        settings['audio'] = {'clips': list(audio.clips), 'chatter_interval': audio.chatter_interval}
+    return settings
+
+def normalize(config, baseline):
+    # A complete, checked settings dict: config over baseline. Raises
+    # ValueError naming the first bad setting.
+    if not isinstance(config, dict):
+        raise ValueError('config must be an object')
+    unknown = set(config) - set(baseline)
+    if unknown:
+        raise ValueError('unknown section %s' % ', '.join(sorted(unknown)))
+    for name, section in config.items():
+        if not isinstance(section, dict):
+            raise ValueError('%s must be an object' % name)
+    result = {}
+    result['shaping'] = smilebot_shaping.normalize(config.get('shaping', baseline['shaping']))
+
+    motor = dict(baseline['motor'])
+    for key, value in config.get('motor', {}).items():
+        if key not in MOTOR_LIMITS:
+            raise ValueError('unknown motor setting %s' % key)
+        motor[key] = check_number(value, *MOTOR_LIMITS[key], where='motor.' + key)
+    result['motor'] = motor
+
+    pins = dict(baseline['pins'])
+    for side, value in config.get('pins', {}).items():
+        if side not in ('left', 'right'):
+            raise ValueError('unknown pins setting %s' % side)
+        pins[side] = check_pins(value, 'pins.' + side)
+    used = list(pins['left'].values()) + list(pins['right'].values())
+    if len(set(used)) != len(used):
+        raise ValueError('pins must all be different')
+    result['pins'] = pins
+
+    if 'audio' in baseline:
+        audio = dict(baseline['audio'])
+        section = config.get('audio', {})
+        unknown = set(section) - {'clips', 'chatter_interval'}
+        if unknown:
+            raise ValueError('unknown audio setting %s' % ', '.join(sorted(unknown)))
+        if 'clips' in section:
+            clips = section['clips']
+            if isinstance(clips, int) and not isinstance(clips, bool) and 1 <= clips <= MAX_CLIPS:
+                clips = smilebot_audio.clip_paths(clips)
+            elif not (isinstance(clips, list) and clips and all(isinstance(c, str) for c in clips)):
+                raise ValueError('audio.clips must be a clip count or a list of files')
+            clips = [smilebot_audio.resolve_clip(c) for c in clips]
+            for clip in clips:
+                if not os.path.isfile(clip):
+                    raise ValueError('audio clip %s not found' % clip)
+            audio['clips'] = clips
+        if 'chatter_interval' in section:
+            interval = section['chatter_interval']
+            audio['chatter_interval'] = (None if interval is None else
+                                         check_number(interval, 0.1, 3600.0, 'audio.chatter_interval'))
+        result['audio'] = audio
+    return result
+
+class RuntimeConfig:
+
+    def __init__(self, path, audio=None):
+        self.path = path
+        self.audio = audio
+        # Taken before the file is first applied, for keys it leaves out
+        self.baseline = current_settings(audio)
+        self.applied = self.baseline
+
+    def load(self):
+        # Raises OSError or ValueError
+        with open(self.path) as f:
+            return normalize(json.load(f), self.baseline)
+
+    def apply(self, settings, motors_running=True):
+        # Applies the sections that differ from what is running and returns
+        # (applied, refused) section names. Under --motor-process pin and
+        # motor changes are refused, the rest still apply. Raises ValueError
+        # or RuntimeError with nothing applied if a change can't be made.
+        # Before the motors are set up, pins are only recorded.
+        changed = {name for name in settings if settings[name] != self.applied.get(name)}
+        refused = changed & {'pins', 'motor'} if core.shared is not None else set()
+        changed -= refused
+        shaping = smilebot_shaping.compile_shaping(settings['shaping']) if 'shaping' in changed else None
+        if 'pins' in changed:
+            left, right = settings['pins']['left'], settings['pins']['right']
+            if motors_running:
+                core.change_pins(left, right)
+            else:
+                core.LEFT_MOTOR_PINS, core.RIGHT_MOTOR_PINS = dict(left), dict(right)
+        if shaping is not None:
+            core.shaping = shaping
+        if 'motor' in changed:
+            motor = settings['motor']
+            core.set_loop_settings(motor['rate_hz'], motor['left_slew_rate'],
+                                   motor['right_slew_rate'], motor['keepalive'])
+        if 'audio' in changed:
+            self.audio.configure(settings['audio']['clips'], settings['audio']['chatter_interval'])
+        self.applied = {name: settings[name] if name in changed else self.applied[name]
+                        for name in settings}
+        return sorted(changed), sorted(refused)
+
+    def reload(self):
+        # For the watcher: applies the file, reports rather than raises
+        try:
+            changed, refused = self.apply(self.load())
+        except (OSError, ValueError, RuntimeError) as e:
+            reload_errors.inc()
+            print("Config %s not applied: %s" % (self.path, e))
+            return
+        if changed:
+            reloads.inc()
+            print("Config %s applied: %s" % (self.path, ', '.join(changed)))
+        if refused:
+            reload_errors.inc()
+            print("Config %s not applied until a restart under --motor-process: %s"
+                  % (self.path, ', '.join(refused)))
+
+# --- Watching ---
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, then len bytes of name
+
+def inotify_watch(directory):
+    # An inotify fd watching directory for files being written or moved in,
+    # None where inotify isn't available. The directory is watched rather
+    # than the file so editors that save by renaming a new file over the
+    # old one are still seen.
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def read_events(fd):
+    # Names of the files in the events waiting on fd
+    names = []
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            _, _, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            names.append(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+
+class ConfigWatcher(threading.Thread):
+    # Calls config.reload() each time the file is saved
+
+    def __init__(self, config):
+        super().__init__(name='config-watcher', daemon=True)
+        self.config = config
+        self.wake_r, self.wake_w = os.pipe()
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        os.write(self.wake_w, b'x')
+
+    def run(self):
+        path = os.path.abspath(self.config.path)
+        directory, name = os.path.split(path)
+        fd = inotify_watch(directory)
+        try:
+            if fd is None:
+                self.poll(path)
+            else:
+                self.watch(fd, name)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+
+    def watch(self, fd, name):
+        while not self.stopped:
+            ready, _, _ = select.select([fd, self.wake_r], [], [])
+            if self.wake_r in ready:
+                return
+            if name not in read_events(fd):
+                continue
+            # Let the editor finish, then reload once
+            while select.select([fd], [], [], DEBOUNCE)[0]:
+                read_events(fd)
+            self.config.reload()
+
+    def poll(self, path):
+        def stamp():
+            try:
+                st = os.stat(path)
+                return st.st_mtime_ns, st.st_size
+            except OSError:
+                return None
+        last = stamp()
+        while not self.stopped:
+            if select.select([self.wake_r], [], [], POLL_INTERVAL)[0]:
+                return
+            current = stamp()
+            if current != last and current is not None:
+                last = current
+                self.config.reload()
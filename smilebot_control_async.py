@@ -0,0 +1,323 @@
+"""Single event loop control server, an alternative to smilebot_control_v3.
+
+Serves the same routes as v3 from one asyncio loop with aiohttp instead of
+Werkzeug's thread-per-request dev server, which keeps memory flat and the
+GIL quiet during joystick bursts on a Pi Zero. The motor loop keeps its own
+thread so a busy event loop can never delay a motor write. Compare the two
+modes with bench_server.py.
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+from aiohttp import WSMsgType, web
+import smilebot_audio
+import smilebot_core as core
+import smilebot_metrics as metrics
+import smilebot_odometry
+import smilebot_page as page
+import smilebot_profile
+import smilebot_shaping
+import smilebot_video
+
+static_assets = page.compile_static()
+control_panel = page.compile_control_panel(static_assets)
+
+# Same audio behaviour as v3
+audio = smilebot_audio.AudioService(chatter_interval=2)
+core.arm_listeners.append(lambda armed: armed and audio.say())
+
+# smilebot_video.VideoService when started with --video, and an event
+# swapped for a fresh one each time it publishes a frame
+video = None
+video_frame = None
+
+def send_compiled(request, asset, cache_control=None):
+    if asset.not_modified(request.headers.get('If-None-Match')):
+        return web.Response(status=304, headers=asset.headers('identity', cache_control))
+    coding, body = asset.negotiate(request.headers.get('Accept-Encoding'))
+    headers = asset.headers(coding, cache_control)
+    headers['Content-Type'] = asset.content_type
+    return web.Response(body=body, headers=headers)
+
+def form_int(form, key):
+    # Same as Flask's form.get(key, type=int)
+    try:
+        return int(form[key])
+    except (KeyError, ValueError):
+        return None
+
+async def read_json(request):
+    # Same as Flask's get_json(silent=True): None unless the body is JSON
+    # sent as JSON
+    content_type = request.content_type
+    if not (content_type == 'application/json' or
+            (content_type.startswith('application/') and content_type.endswith('+json'))):
+        return None
+    try:
+        return json.loads(await request.read())
+    except ValueError:  # JSONDecodeError, or bytes that aren't UTF-8/16/32
+        return None
+
+# --- Routes ---
+
+async def index(request):
+    return send_compiled(request, control_panel)
+
+async def static_asset(request):
+    asset = static_assets.get(request.match_info['filename'])
+    if asset is None:
+        raise web.HTTPNotFound()
+    # Only a versioned URL is safe to cache forever
+    if request.query.get('v') == asset.version:
+        return send_compiled(request, asset)
+    return send_compiled(request, asset, page.PAGE_CACHE_CONTROL)
+
+async def joystick(request):
+    received = time.monotonic() if metrics.enabled else None
+    form = await request.post()
+    client = core.client_id(form.get('client'))
+    try:
+        throttle = float(form.get('throttle', 0.0))
+        steering = float(form.get('steering', 0.0))
+        core.set_joystick(throttle, steering, form_int(form, 'seq'), received, client)
+    except Exception:
+        core.set_joystick(0.0, 0.0, client=client)
+    return web.Response(text='OK')
+
+async def joystick_batch(request):
+    received = time.monotonic() if metrics.enabled else None
+    data = await read_json(request)
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        applied = core.apply_batch(data.get('samples'), received, core.client_id(data.get('client')))
+    except ValueError as e:
+        return web.json_response({'error': str(e)}, status=400)
+    return web.json_response({'applied': applied, 'seq': core.current_command.seq,
+                              'send_hz': core.send_rate.check()})
+
+async def arm(request):
+    form = await request.post()
+    core.set_armed(form.get('state') == 'true')
+    return web.Response(text='OK')
+
+async def say(request):
+    form = await request.post()
+    clip = form.get('clip')
+    if clip is not None and not audio.knows(clip):
+        raise web.HTTPNotFound()
+    if not audio.say(clip):
+        return web.Response(status=503, text='Busy')
+    return web.Response(text='OK')
+
+async def metrics_endpoint(request):
+    if request.query.get('format') == 'json':
+        return web.json_response(metrics.render_json())
+    return web.Response(text=metrics.render_prometheus(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+async def telemetry(request):
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                           'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+    await response.prepare(request)
+    stream = core.TelemetryStream()
+    try:
+        await response.write(b'retry: 1000\n\n')
+        while core.running:
+            event = stream.poll()
+            if event is not None:
+                # write() waits for the transport to drain, so a slow
+                # client holds up only its own stream
+                await response.write(event.encode())
+            await asyncio.sleep(core.TELEMETRY_INTERVAL)
+    except ConnectionResetError:
+        pass
+    return response
+
+def notify_frame():
+    global video_frame
+    ready, video_frame = video_frame, asyncio.Event()
+    ready.set()
+
+async def start_video_listener(app):
+    global video_frame
+    video_frame = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    video.frames.listeners.append(lambda: loop.call_soon_threadsafe(notify_frame))
+
+async def video_feed(request):
+    if video is None:
+        raise web.HTTPNotFound()
+    response = web.StreamResponse(headers={'Content-Type': smilebot_video.CONTENT_TYPE,
+                                           'Cache-Control': 'no-cache, no-store',
+                                           'X-Accel-Buffering': 'no'})
+    await response.prepare(request)
+    frame_id = 0
+    try:
+        while core.running:
+            latest_id, chunk = video.frames.latest()
+            if latest_id == frame_id or chunk is None:
+                try:
+                    await asyncio.wait_for(video_frame.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            frame_id = latest_id
+            await response.write(chunk)
+    except ConnectionResetError:
+        pass
+    return response
+
+async def shaping(request):
+    # POST a whole shaping config (see smilebot_shaping) to swap it in while driving
+    if request.method == 'POST':
+        config = await read_json(request)
+        if config is None:
+            return web.json_response({'error': 'expected a JSON object'}, status=400)
+        try:
+            core.set_shaping(config)
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+    return web.json_response(core.shaping.config)
+
+async def pose(request):
+    # Dead reckoned pose since startup, or since the last POST, which resets it
+    if request.method == 'POST':
+        core.reset_pose()
+    return web.json_response(smilebot_odometry.pose_dict(core.current_pose()))
+
+async def debug_profile(request):
+    # Collapsed stacks of every thread over ?seconds=, see smilebot_profile.
+    # Sampled from an executor thread so the event loop shows up too.
+    status, content_type, body = await asyncio.get_running_loop().run_in_executor(
+        None, smilebot_profile.respond, request.query.get('seconds'))
+    return web.Response(status=status, text=body, content_type=content_type)
+
+async def control_socket(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    client = core.client_id(request.query.get('client')) or object()
+    try:
+        async for msg in ws:
+            if msg.type == WSMsgType.TEXT:
+                message = msg.data
+            elif msg.type == WSMsgType.BINARY:
+                message = msg.data.decode('ascii', 'replace')
+            else:
+                continue
+            reply = core.handle_control_frame(message, client)
+            if reply is not None:
+                await ws.send_str(reply)
+    finally:
+        # Never keep driving on the last stick position of a dead link, but
+        # a viewer's tab closing mustn't stop whoever is driving
+        core.release_client(client)
+    return ws
+
+async def shutdown(request):
+    core.cleanup()
+    os._exit(0)
+
+app = web.Application()
+app.add_routes([
+    web.get('/', index),
+    web.get('/static/{filename:.+}', static_asset),
+    web.post('/joystick', joystick),
+    web.post('/joystick/batch', joystick_batch),
+    web.post('/arm', arm),
+    web.post('/say', say),
+    web.get('/metrics', metrics_endpoint),
+    web.get('/telemetry', telemetry),
+    web.get('/video', video_feed),
+    web.get('/shaping', shaping),
+    web.post('/shaping', shaping),
+    web.get('/pose', pose),
+    web.post('/pose', pose),
+    web.get('/debug/profile', debug_profile),
+    web.get('/ws', control_socket),
+    web.post('/shutdown', shutdown),
+])
+
+def report_ready(message):
+    # run_app prints its banner once the site is listening
+    core.report_startup('smilebot_control_async')
+    print(message)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Robot control panel server, asyncio edition")
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--shaping', metavar='FILE',
+                        help="stick and motor shaping config, see smilebot_shaping")
+    parser.add_argument('--config', metavar='FILE',
+                        help="runtime config, reloaded when saved, see smilebot_config")
+    parser.add_argument('--record', metavar='FILE',
+                        help="log every accepted command, see smilebot_record")
+    parser.add_argument('--video', metavar='SOURCE',
+                        help="serve /video from 'synthetic', 'picamera' or an OpenCV device")
+    parser.add_argument('--video-fps', type=float, default=smilebot_video.VIDEO_FPS)
+    parser.add_argument('--udp', type=int, metavar='PORT',
+                        help="also take commands over UDP, see smilebot_udp")
+    parser.add_argument('--udp-key-file',
+                        help="shared secret UDP packets must be signed with, or set SMILEBOT_UDP_KEY")
+    args = parser.parse_args()
+    core.mark_startup('server imported')
+    if args.shaping:
+        core.set_shaping(smilebot_shaping.read_config(args.shaping))
+    config_watcher = None
+    if args.config:
+        import smilebot_config
+        runtime_config = smilebot_config.RuntimeConfig(args.config, audio)
+        try:
+            # Before the motors are set up, so its pins are the ones claimed
+            runtime_config.apply(runtime_config.load(), motors_running=False)
+        except (OSError, ValueError, RuntimeError) as e:
+            raise SystemExit("Bad config: %s" % e)
+    if args.record:
+        import smilebot_record
+        core.recorder = smilebot_record.Recorder(args.record)
+    udp_listener = None
+    try:
+        print("Initializing motors and starting motor control loop")
+
+        core.init_motors()
+        motor_thread = threading.Thread(target=core.motor_control_loop, name='motor-loop', daemon=True)
+        motor_thread.start()
+
+        audio.start()
+        print("Motor control and audio started")
+
+        if args.config:
+            config_watcher = smilebot_config.ConfigWatcher(runtime_config)
+            config_watcher.start()
+
+        if args.udp:
+            import smilebot_udp
+            udp_listener = smilebot_udp.UdpListener(args.udp, key=smilebot_udp.load_key(args.udp_key_file))
+            udp_listener.start()
+            print("Listening for UDP control on port %d" % args.udp)
+
+        if args.video:
+            video = smilebot_video.VideoService(smilebot_video.open_source(args.video),
+                                                fps=args.video_fps)
+            app.on_startup.append(start_video_listener)
+            video.start()
+
+        web.run_app(app, host='0.0.0.0', port=args.port, access_log=None, print=report_ready)
+
+    except KeyboardInterrupt:
+        print("\nProgram interrupted by user. Exiting...")
+    finally:
+        if config_watcher is not None:
+            config_watcher.stop()
+        core.cleanup()
+        audio.stop()
+        if video is not None:
+            video.stop()
+        if udp_listener is not None:
+            udp_listener.stop()
+        if core.recorder is not None:
+            core.recorder.close()
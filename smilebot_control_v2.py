@@ -2,81 +2,11 @@ import os
 import time
 import threading
 from flask import Flask, Response, render_template_string, request
-from gpiozero import Motor
+import smilebot_core as core
+import smilebot_profile
 
 app = Flask(__name__)
 
-# Motor Initialization
-right_motor = Motor(forward=17, backward=27, enable=12)
-left_motor = Motor(forward=23, backward=22, enable=13)
-
-# Motor control state
-current_throttle = 0.0
-current_steering = 0.0
-MOTOR_UPDATE_INTERVAL = 0.05  # seconds
-
-# Deadzone logic
-DEAD_ZONE = 0.2  # 20% dead zone
-def apply_dead_zone(value, dead_zone):
-    if abs(value) < dead_zone:
-        return 0
-    return (value - dead_zone * (1 if value > 0 else -1)) / (1 - dead_zone)
-
-# Motor arming state
-motors_armed = False
-motors_armed_lock = threading.Lock()
-
-# Global running flag for threads
-running = True
-
-# --- Utility Functions ---
-
-def cleanup():
-    global running
-    running = False
-    print("Stopping motors")
-    try:
-        left_motor.stop()
-    except Exception:
-        pass
-    try:
-        right_motor.stop()
-    except Exception:
-        pass
-    print("Cleanup complete")
-
-# --- Threads ---
-def motor_control_loop():
-    global current_throttle, current_steering, motors_armed
-    while running:
-        with motors_armed_lock:
-            armed = motors_armed
-        if not armed:
-            left_motor.stop()
-            right_motor.stop()
-            time.sleep(MOTOR_UPDATE_INTERVAL)
-            continue
-        # Map joystick values to motor speeds
-        throttle = current_throttle  # -1 to 1
-        steering = current_steering  # -1 to 1
-        left_speed = throttle + steering
-        right_speed = throttle - steering
-        left_speed = max(-1, min(1, left_speed))
-        right_speed = max(-1, min(1, right_speed))
-        if left_speed > 0:
-            left_motor.forward(left_speed)
-        elif left_speed < 0:
-            left_motor.backward(-left_speed)
-        else:
-            left_motor.stop()
-        if right_speed > 0:
-            right_motor.forward(right_speed)
-        elif right_speed < 0:
-            right_motor.backward(-right_speed)
-        else:
-            right_motor.stop()
-        time.sleep(MOTOR_UPDATE_INTERVAL)
-
 # --- Flask Endpoints ---
 @app.route('/')
 def index():
@@ -175,6 +105,34 @@ def index():
                 font-weight: 500;
                 letter-spacing: 0.04em;
             }
+            #telemetry {
+                margin-top: 12px;
+                width: 180px;
+                font-size: 0.8rem;
+                color: #8a93a8;
+            }
+            .wheel {
+                display: flex;
+                align-items: center;
+                gap: 8px;
+                margin-bottom: 4px;
+            }
+            .bar {
+                position: relative;
+                flex: 1;
+                height: 8px;
+                background: #232a3a;
+                border-radius: 4px;
+                overflow: hidden;
+            }
+            .bar div {
+                position: absolute;
+                top: 0;
+                bottom: 0;
+                left: 50%;
+                width: 0;
+                background: #4e8cff;
+            }
         </style>
     </head>
     <body>
@@ -189,6 +147,11 @@ def index():
                 </label>
                 <span id="arm-label">Motors Disarmed</span>
             </div>
+            <div id="telemetry">
+                <div class="wheel"><span>L</span><div class="bar"><div id="left-bar"></div></div></div>
+                <div class="wheel"><span>R</span><div class="bar"><div id="right-bar"></div></div></div>
+                <div id="telemetry-text">No telemetry</div>
+            </div>
         </div>
         <script>
             var throttle = 0.0;
@@ -230,6 +193,51 @@ def index():
             armSwitch.addEventListener('change', function() {
                 setArmState(armSwitch.checked);
             });
+            // Actual motor state pushed by the server, as on the v3 page. Only
+            // the newest event is kept and drawn on the next animation frame,
+            // and it corrects the arm label.
+            var leftBar = document.getElementById('left-bar');
+            var rightBar = document.getElementById('right-bar');
+            var telemetryText = document.getElementById('telemetry-text');
+            var latestTelemetry = null;
+            var renderScheduled = false;
+            function drawBar(bar, speed) {
+                var width = Math.min(Math.abs(speed), 1) * 50;
+                bar.style.width = width + '%';
+                bar.style.left = (speed < 0 ? 50 - width : 50) + '%';
+            }
+            function renderTelemetry() {
+                renderScheduled = false;
+                var t = latestTelemetry;
+                if (t === null) {
+                    telemetryText.textContent = 'No telemetry';
+                    return;
+                }
+                drawBar(leftBar, t.left);
+                drawBar(rightBar, t.right);
+                telemetryText.textContent = 'loop ' + t.period_ms.toFixed(1) + ' ms, command ' +
+                    (t.age_ms === null ? '-' : t.age_ms + ' ms') + ' old';
+                armLabel.textContent = t.armed ? 'Motors Armed' : 'Motors Disarmed';
+                armLabel.style.color = t.armed ? '#4e8cff' : '#f5f6fa';
+            }
+            function scheduleRender() {
+                if (!renderScheduled) {
+                    renderScheduled = true;
+                    requestAnimationFrame(renderTelemetry);
+                }
+            }
+            if (window.EventSource) {
+                var telemetry = new EventSource('/telemetry');
+                telemetry.onmessage = function(evt) {
+                    latestTelemetry = JSON.parse(evt.data);
+                    scheduleRender();
+                };
+                telemetry.onerror = function() {
+                    // EventSource reconnects by itself
+                    latestTelemetry = null;
+                    scheduleRender();
+                };
+            }
             // Initialize arm state as disarmed
             setArmState(false);
         </script>
@@ -239,38 +247,55 @@ def index():
 
 @app.route('/joystick', methods=['POST'])
 def joystick():
-    global current_throttle, current_steering
     try:
         throttle = float(request.form.get('throttle', 0.0))
         steering = float(request.form.get('steering', 0.0))
-        current_throttle = max(-1, min(1, apply_dead_zone(throttle, DEAD_ZONE)))
-        current_steering = max(-1, min(1, apply_dead_zone(steering, DEAD_ZONE)))
+        core.set_joystick(throttle, steering)
     except Exception:
-        current_throttle = 0.0
-        current_steering = 0.0
+        core.set_joystick(0.0, 0.0)
     return 'OK'
 
 @app.route('/arm', methods=['POST'])
 def arm():
-    global motors_armed
     state = request.form.get('state')
-    with motors_armed_lock:
-        motors_armed = (state == 'true')
+    core.set_armed(state == 'true')
     return 'OK'
 
+@app.route('/telemetry')
+def telemetry():
+    def events():
+        stream = core.TelemetryStream()
+        yield 'retry: 1000\n\n'
+        while core.running:
+            event = stream.poll()
+            if event is not None:
+                yield event
+            time.sleep(core.TELEMETRY_INTERVAL)
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/debug/profile')
+def debug_profile():
+    # Collapsed stacks of every thread over ?seconds=, see smilebot_profile
+    status, content_type, body = smilebot_profile.respond(request.args.get('seconds'))
+    return Response(body, status=status, mimetype=content_type)
+
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
-    cleanup()
+    core.cleanup()
     os._exit(0)
 
 if __name__ == '__main__':
+    core.mark_startup('server imported')
     try:
         print("Initializing motors and starting motor control loop")
-        motor_thread = threading.Thread(target=motor_control_loop, daemon=True)
+        core.init_motors()
+        motor_thread = threading.Thread(target=core.motor_control_loop, name='motor-loop', daemon=True)
         motor_thread.start()
         print("Motor control thread started")
+        core.report_startup('smilebot_control_v2')
         app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False, threaded=True)
     except KeyboardInterrupt:
         print("\nProgram interrupted by user. Exiting...")
     finally:
-        cleanup()
+        core.cleanup()
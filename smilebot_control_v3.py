@@ -1,293 +1,281 @@
 import os
 import time
+import argparse
 import threading
-import subprocess
-from flask import Flask, render_template_string, request
-from gpiozero import Motor
+from flask import Flask, Response, abort, jsonify, request
+import smilebot_audio
+import smilebot_core as core
+import smilebot_metrics as metrics
+import smilebot_odometry
+import smilebot_page as page
+import smilebot_profile
+import smilebot_shaping
+import smilebot_video
 
-app = Flask(__name__)
+try:
+    from flask_sock import Sock
+except ImportError:  # page falls back to plain POSTs
+    Sock = None
 
-# Motor Initialization
-right_motor = Motor(forward=17, backward=27, enable=12)
-left_motor = Motor(forward=23, backward=22, enable=13)
+app = Flask(__name__, static_folder=None)
+sock = Sock(app) if Sock is not None else None
 
-# Motor control state
-current_throttle = 0.0
-current_steering = 0.0
-MOTOR_UPDATE_INTERVAL = 0.05  # seconds
+# Plays a random clip every couple of seconds, as beautiful-olive-sam.py
+# did when it ran as a separate process, and one on every arm
+audio = smilebot_audio.AudioService(chatter_interval=2)
+core.arm_listeners.append(lambda armed: armed and audio.say())
 
-# Deadzone logic
-DEAD_ZONE = 0.2  # 20% dead zone
-def apply_dead_zone(value, dead_zone):
-    if abs(value) < dead_zone:
-        return 0
-    return (value - dead_zone * (1 if value > 0 else -1)) / (1 - dead_zone)
+# smilebot_video.VideoService when started with --video
+video = None
 
-# Motor arming state
-motors_armed = False
-motors_armed_lock = threading.Lock()
+# The motor process when started with --motor-process, see smilebot_shm
+motor_proc = None
 
-# Global running flag for threads
-running = True
-
-# --- Utility Functions ---
-
-def cleanup():
-    global running
-    running = False
-    print("Stopping motors")
-    try:
-        left_motor.stop()
-    except Exception:
-        pass
-    try:
-        right_motor.stop()
-    except Exception:
-        pass
-    print("Cleanup complete")
-
-# --- Threads ---
-
-def motor_control_loop():
-    global current_throttle, current_steering, motors_armed
-    while running:
-        with motors_armed_lock:
-            armed = motors_armed
-        if not armed:
-            left_motor.stop()
-            right_motor.stop()
-            time.sleep(MOTOR_UPDATE_INTERVAL)
-            continue
-
-        # Map joystick values to motor speeds
-        throttle = current_throttle  # -1 to 1
-        steering = current_steering  # -1 to 1
-        left_speed = throttle + steering
-        right_speed = throttle - steering
-        left_speed = max(-1, min(1, left_speed))
-        right_speed = max(-1, min(1, right_speed))
-
-        if left_speed > 0:
-            left_motor.forward(left_speed)
-        elif left_speed < 0:
-            left_motor.backward(-left_speed)
-        else:
-            left_motor.stop()
-
-        if right_speed > 0:
-            right_motor.forward(right_speed)
-        elif right_speed < 0:
-            right_motor.backward(-right_speed)
-        else:
-            right_motor.stop()
+# --- Flask Endpoints ---
 
-        time.sleep(MOTOR_UPDATE_INTERVAL)
+# The page and its assets are rendered, hashed and compressed once here,
+# requests only pick a variant. See smilebot_page.
+static_assets = page.compile_static()
+control_panel = page.compile_control_panel(static_assets)
 
-# --- Flask Endpoints ---
+def send_compiled(asset, cache_control=None):
+    if asset.not_modified(request.headers.get('If-None-Match')):
+        return Response(status=304, headers=asset.headers('identity', cache_control))
+    coding, body = asset.negotiate(request.headers.get('Accept-Encoding'))
+    return Response(body, content_type=asset.content_type,
+                    headers=asset.headers(coding, cache_control))
 
 @app.route('/')
 def index():
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <title>Robot Control Panel</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <script src="https://code.jquery.com/jquery-3.6.0.min.js"></script>
-        <script src="https://cdnjs.cloudflare.com/ajax/libs/nipplejs/0.9.0/nipplejs.min.js"></script>
-        <style>
-            html, body {
-                height: 100%;
-                margin: 0;
-                padding: 0;
-                background: #181a20;
-                color: #f5f6fa;
-                font-family: 'Segoe UI', 'Roboto', 'Arial', sans-serif;
-                overflow: hidden;
-            }
-            body {
-                display: flex;
-                flex-direction: column;
-                height: 100vh;
-                width: 100vw;
-            }
-            #main-content {
-                flex: 1 1 auto;
-                display: flex;
-                flex-direction: column;
-                align-items: center;
-                justify-content: center;
-                height: 100vh;
-                width: 100vw;
-                overflow: hidden;
-            }
-            #joystick-container {
-                z-index: 3;
-                width: 140px;
-                height: 140px;
-                background: rgba(24,26,32,0.85);
-                border-radius: 18px;
-                box-shadow: 0 4px 32px 0 #000a;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-            }
-            #joystick {
-                width: 120px;
-                height: 120px;
-                position: relative;
-            }
-            #arm-switch-container {
-                margin-top: 20px;
-                display: flex;
-                align-items: center;
-                gap: 16px;
-            }
-            .switch {
-                position: relative;
-                display: inline-block;
-                width: 60px;
-                height: 34px;
-            }
-            .switch input {display:none;}
-            .slider {
-                position: absolute;
-                cursor: pointer;
-                top: 0; left: 0; right: 0; bottom: 0;
-                background: #232a3a;
-                border-radius: 34px;
-                transition: .4s;
-            }
-            .slider:before {
-                position: absolute;
-                content: "";
-                height: 26px;
-                width: 26px;
-                left: 4px;
-                bottom: 4px;
-                background: #f5f6fa;
-                border-radius: 50%;
-                transition: .4s;
-                box-shadow: 0 2px 8px 0 #0006;
-            }
-            input:checked + .slider {
-                background: linear-gradient(90deg, #4e8cff 0%, #1e3c72 100%);
-            }
-            input:checked + .slider:before {
-                transform: translateX(26px);
-                background: #4e8cff;
-            }
-            #arm-label {
-                font-size: 1.1rem;
-                font-weight: 500;
-                letter-spacing: 0.04em;
-            }
-        </style>
-    </head>
-    <body>
-        <div id="main-content">
-            <div id="joystick-container">
-                <div id="joystick"></div>
-            </div>
-            <div id="arm-switch-container">
-                <label class="switch">
-                  <input type="checkbox" id="arm-switch">
-                  <span class="slider"></span>
-                </label>
-                <span id="arm-label">Motors Disarmed</span>
-            </div>
-        </div>
-        <script>
-            var throttle = 0.0;
-            var steering = 0.0;
-            var joystick = nipplejs.create({
-                zone: document.getElementById('joystick'),
-                mode: 'static',
-                position: {left: '50%', top: '50%'},
-                color: '#4e8cff',
-                size: 120
-            });
-            function sendJoystick(throttle, steering) {
-                $.post('/joystick', {throttle: throttle, steering: steering});
-            }
-            joystick.on('move', function(evt, data) {
-                if (data && data.distance) {
-                    var angle = data.angle ? data.angle.radian : 0;
-                    var dist = Math.min(data.distance, 50);
-                    var norm = dist / 50;
-                    var x = Math.cos(angle) * norm;
-                    var y = Math.sin(angle) * norm;
-                    sendJoystick(-y, x);
-                }
-            });
-            joystick.on('end', function() {
-                sendJoystick(0, 0);
-            });
-            var armSwitch = document.getElementById('arm-switch');
-            var armLabel = document.getElementById('arm-label');
-            function setArmState(armed) {
-                $.post('/arm', {state: armed ? 'true' : 'false'});
-                armLabel.textContent = armed ? 'Motors Armed' : 'Motors Disarmed';
-                if (armed) {
-                    armLabel.style.color = '#4e8cff';
-                } else {
-                    armLabel.style.color = '#f5f6fa';
-                }
-            }
-            armSwitch.addEventListener('change', function() {
-                setArmState(armSwitch.checked);
-            });
-            // Initialize arm state as disarmed
-            setArmState(false);
-        </script>
-    </body>
-    </html>
-    ''')
+    return send_compiled(control_panel)
+
+@app.route('/static/<path:filename>')
+def static_asset(filename):
+    asset = static_assets.get(filename)
+    if asset is None:
+        abort(404)
+    # Only a versioned URL is safe to cache forever
+    if request.args.get('v') == asset.version:
+        return send_compiled(asset)
+    return send_compiled(asset, page.PAGE_CACHE_CONTROL)
 
 @app.route('/joystick', methods=['POST'])
 def joystick():
-    global current_throttle, current_steering
+    received = time.monotonic() if metrics.enabled else None
+    client = core.client_id(request.form.get('client'))
     try:
         throttle = float(request.form.get('throttle', 0.0))
         steering = float(request.form.get('steering', 0.0))
-        current_throttle = max(-1, min(1, apply_dead_zone(throttle, DEAD_ZONE)))
-        current_steering = max(-1, min(1, apply_dead_zone(steering, DEAD_ZONE)))
+        core.set_joystick(throttle, steering, request.form.get('seq', type=int), received, client)
     except Exception:
-        current_throttle = 0.0
-        current_steering = 0.0
+        core.set_joystick(0.0, 0.0, client=client)
     return 'OK'
 
+@app.route('/joystick/batch', methods=['POST'])
+def joystick_batch():
+    received = time.monotonic() if metrics.enabled else None
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        applied = core.apply_batch(data.get('samples'), received, core.client_id(data.get('client')))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(applied=applied, seq=core.current_command.seq, send_hz=core.send_rate.check())
+
 @app.route('/arm', methods=['POST'])
 def arm():
-    global motors_armed
     state = request.form.get('state')
-    with motors_armed_lock:
-        motors_armed = (state == 'true')
+    core.set_armed(state == 'true')
+    return 'OK'
+
+@app.route('/say', methods=['POST'])
+def say():
+    # Optional clip=thingN.mp3, otherwise a random one
+    clip = request.form.get('clip')
+    if clip is not None and not audio.knows(clip):
+        abort(404)
+    if not audio.say(clip):
+        return 'Busy', 503
     return 'OK'
 
+@app.route('/metrics')
+def metrics_endpoint():
+    if request.args.get('format') == 'json':
+        return jsonify(metrics.render_json())
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/telemetry')
+def telemetry():
+    # One thread per viewer with Werkzeug, each parked in time.sleep or in
+    # a socket write the client hasn't drained yet
+    def events():
+        stream = core.TelemetryStream()
+        yield 'retry: 1000\n\n'
+        while core.running:
+            event = stream.poll()
+            if event is not None:
+                yield event
+            time.sleep(core.TELEMETRY_INTERVAL)
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/video')
+def video_feed():
+    if video is None:
+        abort(404)
+    # Every viewer sends the same pre-built chunk, skipping frames it was
+    # too slow for rather than queueing them
+    def frames():
+        frame_id = 0
+        while core.running:
+            frame_id, chunk = video.frames.wait(frame_id, timeout=1.0)
+            if chunk is not None:
+                yield chunk
+    return Response(frames(), mimetype=smilebot_video.CONTENT_TYPE,
+                    headers={'Cache-Control': 'no-cache, no-store', 'X-Accel-Buffering': 'no'})
+
+@app.route('/shaping', methods=['GET', 'POST'])
+def shaping():
+    # POST a whole shaping config (see smilebot_shaping) to swap it in while driving
+    if request.method == 'POST':
+        config = request.get_json(silent=True)
+        if config is None:
+            return jsonify(error='expected a JSON object'), 400
+        try:
+            core.set_shaping(config)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+    return jsonify(core.shaping.config)
+
+@app.route('/pose', methods=['GET', 'POST'])
+def pose():
+    # Dead reckoned pose since startup, or since the last POST, which resets it
+    if request.method == 'POST':
+        core.reset_pose()
+    return jsonify(smilebot_odometry.pose_dict(core.current_pose()))
+
+@app.route('/debug/profile')
+def debug_profile():
+    # Collapsed stacks of every thread over ?seconds=, see smilebot_profile
+    status, content_type, body = smilebot_profile.respond(request.args.get('seconds'))
+    return Response(body, status=status, mimetype=content_type)
+
+if sock is not None:
+    @sock.route('/ws')
+    def control_socket(ws):
+        client = core.client_id(request.args.get('client')) or object()
+        try:
+            while True:
+                message = ws.receive()
+                if isinstance(message, bytes):
+                    message = message.decode('ascii', 'replace')
+                reply = core.handle_control_frame(message, client)
+                if reply is not None:
+                    ws.send(reply)
+        finally:
+            # Never keep driving on the last stick position of a dead link, but
+            # a viewer's tab closing mustn't stop whoever is driving
+            core.release_client(client)
+
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
-    cleanup()
+    core.cleanup()
+    # os._exit skips the finally at the bottom, so stop the motor process
+    # and unlink its segment here
+    if motor_proc is not None:
+        smilebot_shm.stop_motor_process(motor_proc)
     os._exit(0)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Robot control panel server")
+    parser.add_argument('--motor-process', action='store_true',
+                        help="run the motor loop in its own process, see smilebot_shm")
+    parser.add_argument('--motor-priority', type=int, default=0,
+                        help="SCHED_FIFO priority for the motor process (needs root)")
+    parser.add_argument('--motor-rate', type=float, default=core.MOTOR_RATE_HZ,
+                        help="motor loop step rate in Hz while outputs are ramping")
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--shaping', metavar='FILE',
+                        help="stick and motor shaping config, see smilebot_shaping")
+    parser.add_argument('--config', metavar='FILE',
+                        help="runtime config, reloaded when saved, see smilebot_config")
+    parser.add_argument('--record', metavar='FILE',
+                        help="log every accepted command, see smilebot_record")
+    parser.add_argument('--video', metavar='SOURCE',
+                        help="serve /video from 'synthetic', 'picamera' or an OpenCV device")
+    parser.add_argument('--video-fps', type=float, default=smilebot_video.VIDEO_FPS)
+    parser.add_argument('--udp', type=int, metavar='PORT',
+                        help="also take commands over UDP, see smilebot_udp")
+    parser.add_argument('--udp-key-file',
+                        help="shared secret UDP packets must be signed with, or set SMILEBOT_UDP_KEY")
+    args = parser.parse_args()
+    core.mark_startup('server imported')
+    try:
+        core.MOTOR_RATE_HZ = core.check_motor_rate(args.motor_rate)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.shaping:
+        core.set_shaping(smilebot_shaping.read_config(args.shaping))
+    config_watcher = None
+    if args.config:
+        import smilebot_config
+        runtime_config = smilebot_config.RuntimeConfig(args.config, audio)
+        try:
+            # Before the motors are set up, so its pins are the ones claimed
+            runtime_config.apply(runtime_config.load(), motors_running=False)
+        except (OSError, ValueError, RuntimeError) as e:
+            raise SystemExit("Bad config: %s" % e)
+    udp_listener = None
+    if args.record:
+        import smilebot_record
+        core.recorder = smilebot_record.Recorder(args.record)
     try:
         print("Initializing motors and starting motor control loop")
 
-        motor_thread = threading.Thread(target=motor_control_loop, daemon=True)
-        motor_thread.start()
+        if args.motor_process:
+            # Imported here so the default mode doesn't pay for it
+            import smilebot_shm
+            motor_proc = smilebot_shm.start_motor_process(args.motor_priority)
+        else:
+            core.init_motors()
+            motor_thread = threading.Thread(target=core.motor_control_loop, name='motor-loop', daemon=True)
+            motor_thread.start()
+
+        audio.start()
+        print("Motor control and audio started")
+
+        if args.config:
+            config_watcher = smilebot_config.ConfigWatcher(runtime_config)
+            config_watcher.start()
+
+        if args.udp:
+            import smilebot_udp
+            udp_listener = smilebot_udp.UdpListener(args.udp, key=smilebot_udp.load_key(args.udp_key_file))
+            udp_listener.start()
+            print("Listening for UDP control on port %d" % args.udp)
 
-        # Start the external script asynchronously with subprocess
-        proc = subprocess.Popen(["python3", "beautiful-olive-sam.py"])
-        print("Motor control thread and beautiful-olive-sam.py started")
+        if args.video:
+            video = smilebot_video.VideoService(smilebot_video.open_source(args.video),
+                                                fps=args.video_fps)
+            video.start()
 
-        app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False, threaded=True)
+        # Werkzeug binds the socket a moment later, inside app.run
+        core.report_startup('smilebot_control_v3')
+        app.run(host='0.0.0.0', port=args.port, debug=False, use_reloader=False, threaded=True)
 
     except KeyboardInterrupt:
         print("\nProgram interrupted by user. Exiting...")
     finally:
-        cleanup()
-        # Optionally, terminate the subprocess if still running
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait()
+        if config_watcher is not None:
+            config_watcher.stop()
+        core.cleanup()
+        if motor_proc is not None:
+            smilebot_shm.stop_motor_process(motor_proc)
+        audio.stop()
+        if video is not None:
+            video.stop()
+        if udp_listener is not None:
+            udp_listener.stop()
+        if core.recorder is not None:
+            core.recorder.close()
@@ -0,0 +1,780 @@
+"""Robot state and motor loop shared by every entry point.
+
+Holds the pin map, mixing, dead zone, command snapshot, arm state and
+motor_control_loop so the Flask servers (smilebot_control_v2 and v3), the
+asyncio server (smilebot_control_async) and smilebot_cli drive the robot
+through exactly the same code. Importing this module is cheap: gpiozero
+is only loaded by init_motors(), so entry points can get their own
+imports and setup under way first. Startup marks record how long each
+entry point takes from process start to drivable.
+"""
+import json
+import math
+import os
+import time
+import threading
+from collections import OrderedDict, deque, namedtuple
+import smilebot_metrics as metrics
+import smilebot_odometry
+import smilebot_shaping
+
+def process_start_time():
+    # time.monotonic() at process start, interpreter start up included.
+    # Falls back to now (module import) where /proc isn't available.
+    try:
+        with open('/proc/self/stat') as f:
+            # starttime, field 22, in clock ticks since boot
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.monotonic() - (uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+process_started = process_start_time()
+startup_marks = []  # (label, seconds since process start)
+
+def mark_startup(label):
+    elapsed = time.monotonic() - process_started
+    startup_marks.append((label, elapsed))
+    return elapsed
+
+def report_startup(name):
+    # Call once the entry point can take commands
+    ready = mark_startup('ready')
+    print("%s ready %.3f s after process start (%s)"
+          % (name, ready, ', '.join('%s %.3f s' % mark for mark in startup_marks[:-1])))
+
+mark_startup('core imported')
+metrics.gauge('smilebot_startup_seconds', 'Process start to ready to drive',
+              lambda: dict(startup_marks).get('ready', 0.0))
+
+# Motor Initialization, done by whichever process runs the motor loop.
+# Speeds passed to the motors are positive for Motor.forward on these pins.
+RIGHT_MOTOR_PINS = dict(forward=17, backward=27, enable=12)
+LEFT_MOTOR_PINS = dict(forward=23, backward=22, enable=13)
+right_motor = None
+left_motor = None
+
+def init_motors():
+    global right_motor, left_motor
+    from gpiozero import Motor
+    right_motor = Motor(**RIGHT_MOTOR_PINS)
+    left_motor = Motor(**LEFT_MOTOR_PINS)
+    mark_startup('motors')
+
+# Motor control state. Each command is an immutable snapshot swapped in
+# whole, so the motor loop never pairs the throttle of one request with the
+# steering of another. Writers take command_lock, the loop reads lock-free.
+# Command.seq is assigned here and only counts up.
+Command = namedtuple('Command', 'throttle steering seq received')
+current_command = Command(0.0, 0.0, 0, 0.0)
+command_lock = threading.Lock()
+commands_accepted = 0  # by set_joystick, for SendRate
+
+# A client's seq only orders that client's own commands: each page (by the
+# id it sends), control socket or UDP sender has its own last seq, so no
+# client can make another's commands look stale, and a reloaded page starts
+# afresh. Commands sent without a client id share one entry.
+MAX_SEQ = 2 ** 63
+MAX_CLIENT_ID = 64  # characters
+MAX_CLIENTS = 256  # remembered, least recently heard from forgotten first
+
+def check_seq(seq):
+    if not 0 < seq < MAX_SEQ:
+        raise ValueError('seq out of range')
+    return seq
+
+def client_id(value):
+    # A page's client id from a request, None if missing or unusable
+    if isinstance(value, str) and 0 < len(value) <= MAX_CLIENT_ID:
+        return value
+    return None
+
+class ClientSeqs:
+
+    def __init__(self, limit=MAX_CLIENTS):
+        self.limit = limit
+        self.seqs = OrderedDict()  # client -> last accepted seq
+
+    def accept(self, client, seq):
+        # True, and remembered, if seq is newer than client's last. Callers
+        # hold their command lock.
+        last = self.seqs.get(client)
+        if last is not None and seq <= last:
+            return False
+        self.seqs[client] = seq
+        self.seqs.move_to_end(client)
+        if len(self.seqs) > self.limit:
+            self.seqs.popitem(last=False)
+        return True
+
+client_seqs = ClientSeqs()
+command_client = None  # who sent current_command, see release_client
+
+# Joystick samples per /joystick/batch request, of which only the newest
+# drives the motors, see apply_batch
+MAX_BATCH_SAMPLES = 64
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, MAX_BATCH_SAMPLES)
+
+MOTOR_KEEPALIVE_INTERVAL = 1.0  # seconds between re-writes of unchanged outputs
+OUTPUT_EPSILON = 0.01  # smallest speed change worth a PWM write
+
+# While an output is ramping the loop steps on a fixed monotonic schedule
+# at MOTOR_RATE_HZ, moving each motor at most *_SLEW_RATE per second to
+# avoid current spikes. Once outputs settle it goes back to waiting for
+# commands. Disarming always stops at once.
+MOTOR_RATE_HZ = 200
+MIN_MOTOR_RATE_HZ = 10
+MAX_MOTOR_RATE_HZ = 1000
+LEFT_SLEW_RATE = 4.0  # speed units per second, 0 to full in 0.25 s
+RIGHT_SLEW_RATE = 4.0
+# Bumped by set_loop_settings, running MotorLoops recompute their steps
+loop_settings_version = 0
+
+# Pin changes for the motor loop to carry out between passes, see change_pins
+pin_changes = deque()
+
+# Set by /joystick and /arm so the motor loop wakes as soon as a command lands
+motor_update = threading.Event()
+
+# Control latency, one histogram per hop from thumb to motor.
+# Only recorded when SMILEBOT_METRICS=1, see smilebot_metrics.
+send_to_receive = metrics.histogram(
+    'smilebot_send_to_receive_seconds',
+    'Page send to server receive, includes any client clock offset')
+receive_to_publish = metrics.histogram(
+    'smilebot_receive_to_publish_seconds', 'Request receive to command publish')
+publish_to_pickup = metrics.histogram(
+    'smilebot_publish_to_pickup_seconds', 'Command publish to motor loop pickup')
+pickup_to_write = metrics.histogram(
+    'smilebot_pickup_to_write_seconds', 'Motor loop pickup to gpiozero write done')
+command_to_write = metrics.histogram(
+    'smilebot_command_to_write_seconds', 'Command publish to gpiozero write done, end to end')
+step_lateness = metrics.histogram(
+    'smilebot_loop_step_lateness_seconds', 'Motor loop wake up after a slew step deadline')
+commands_stale = metrics.counter(
+    'smilebot_commands_stale_total', 'Joystick commands dropped as out of order')
+motor_writes = metrics.counter(
+    'smilebot_motor_writes_total', 'Motor output updates written to gpiozero')
+batch_sizes = metrics.histogram(
+    'smilebot_joystick_batch_samples', 'Valid samples per joystick batch', BATCH_SIZE_BUCKETS)
+batch_superseded = metrics.counter(
+    'smilebot_joystick_batch_superseded_total',
+    'Batched joystick samples dropped for a newer one in the same batch')
+
+# Stick and motor shaping (dead zone, expo, rate, trim, motor calibration),
+# compiled to lookup tables, see smilebot_shaping. Readers take the current
+# tables once per use and set_shaping swaps in new ones whole, so a change
+# while driving never mixes old and new curves.
+apply_dead_zone = smilebot_shaping.apply_dead_zone
+shaping = smilebot_shaping.compile_shaping()
+
+# Dead reckoned pose, updated by whoever writes the motors, see
+# smilebot_odometry. current_pose() reports it relative to pose_origin so a
+# reset never has to reach into the motor loop, which may be another process.
+odometry = smilebot_odometry.Odometry()
+pose_origin = smilebot_odometry.ORIGIN
+
+# Motor arming state
+motors_armed = False
+motors_armed_lock = threading.Lock()
+
+# Global running flag for threads
+running = True
+
+# SharedControl when the motor loop runs in its own process, see smilebot_shm
+shared = None
+
+# smilebot_record.Recorder when the session is being logged
+recorder = None
+
+# Called with the new state whenever the motors are armed or disarmed
+arm_listeners = []
+
+# Motor loop timing, written only by the loop itself
+class LoopStats:
+    __slots__ = ('iterations', 'pickups', 'pickup_sum', 'pickup_max', 'period_max',
+                 'overruns', 'lateness_max', 'steps', 'lateness_sum', 'period_last',
+                 'left', 'right', 'last_tick')
+
+    def __init__(self):
+        self.iterations = 0
+        self.pickups = 0
+        self.pickup_sum = 0.0  # command publish to loop pickup, seconds
+        self.pickup_max = 0.0
+        self.period_max = 0.0  # longest gap between loop passes, seconds
+        self.overruns = 0  # scheduled slew steps missed entirely
+        self.lateness_max = 0.0  # worst wake up after a step deadline, seconds
+        self.steps = 0  # scheduled slew steps run
+        self.lateness_sum = 0.0  # total wake up delay over those steps, seconds
+        self.period_last = 0.0  # gap before the latest loop pass, seconds
+        self.left = 0.0  # speeds last written to the motors
+        self.right = 0.0
+        self.last_tick = None
+
+    def tick(self, now):
+        if self.last_tick is not None:
+            self.period_last = now - self.last_tick
+            if self.period_last > self.period_max:
+                self.period_max = self.period_last
+        self.last_tick = now
+        self.iterations += 1
+
+    def pickup(self, delay):
+        self.pickups += 1
+        self.pickup_sum += delay
+        if delay > self.pickup_max:
+            self.pickup_max = delay
+
+    def late(self, lateness, missed):
+        self.steps += 1
+        self.lateness_sum += lateness
+        self.overruns += missed
+        if lateness > self.lateness_max:
+            self.lateness_max = lateness
+
+loop_stats = LoopStats()
+
+def read_loop_stats():
+    if shared is not None:
+        return shared.read_stats()
+    return loop_stats
+
+for _field, _help in (('iterations', 'Motor loop passes'),
+                      ('pickups', 'New commands picked up by the motor loop'),
+                      ('pickup_sum', 'Total command publish to pickup delay, seconds'),
+                      ('pickup_max', 'Longest command publish to pickup delay, seconds'),
+                      ('period_max', 'Longest gap between motor loop passes, seconds'),
+                      ('overruns', 'Scheduled motor loop steps missed'),
+                      ('lateness_max', 'Worst motor loop wake up after a step deadline, seconds')):
+    metrics.gauge('smilebot_loop_' + _field, _help,
+                  lambda field=_field: getattr(read_loop_stats(), field))
+
+# --- Utility Functions ---
+
+def cleanup():
+    global running
+    running = False
+    motor_update.set()
+    if shared is not None:
+        shared.write_running(False)
+    print("Stopping motors")
+    try:
+        left_motor.stop()
+    except Exception:
+        pass
+    try:
+        right_motor.stop()
+    except Exception:
+        pass
+    print("Cleanup complete")
+
+def shape(throttle, steering):
+    tables = shaping
+    return tables.throttle.lookup(throttle), tables.steering.lookup(steering)
+
+def set_shaping(config):
+    # Compiles and swaps in a new shaping config, raises ValueError if it
+    # is invalid. Commands already accepted keep the shaping they had.
+    # With --motor-process, motor calibration changes need a restart.
+    global shaping
+    shaping = smilebot_shaping.compile_shaping(config)
+    return shaping.config
+
+def set_joystick(throttle, steering, seq=None, received=None, client=None):
+    # Returns False when seq is not newer than the last one from the same
+    # client, i.e. a request that was overtaken in flight. Commands without
+    # a seq always win. Raises ValueError for a seq out of range. received
+    # is the monotonic time the request arrived, for metrics only.
+    if seq is not None:
+        check_seq(seq)
+    shaped_throttle, shaped_steering = shape(throttle, steering)
+    with command_lock:
+        if seq is not None and not client_seqs.accept(client, seq):
+            if metrics.enabled:
+                commands_stale.inc()
+            return False
+        publish(throttle, steering, shaped_throttle, shaped_steering, client)
+    motor_update.set()
+    if metrics.enabled and received is not None:
+        receive_to_publish.observe(current_command.received - received)
+    return True
+
+def publish(throttle, steering, shaped_throttle, shaped_steering, client):
+    # Under command_lock
+    global current_command, commands_accepted, command_client
+    current_command = Command(shaped_throttle, shaped_steering, current_command.seq + 1,
+                              time.monotonic())
+    command_client = client
+    commands_accepted += 1
+    if shared is not None:
+        shared.write_command(current_command)
+    if recorder is not None:
+        recorder.record(current_command.seq, throttle, steering, motors_armed)
+
+def release_client(client):
+    # A client's link went down: stop if its command is the one driving,
+    # leave anyone else's alone. Returns True if it stopped.
+    with command_lock:
+        if client is None or command_client != client:
+            return False
+        publish(0.0, 0.0, *shape(0.0, 0.0), None)
+    motor_update.set()
+    return True
+
+def note_client_send(t_client):
+    # t_client is the page's Date.now() in ms
+    send_to_receive.observe(max(0.0, time.time() - t_client / 1000.0))
+
+def apply_batch(samples, received=None, client=None):
+    # samples is [[seq, t_client, throttle, steering], ...] from one client,
+    # as coalesced by
+    # the page once per animation frame. Only the newest valid sample drives
+    # the motors, the rest are only counted. Raises ValueError when nothing
+    # in the batch is usable.
+    if not isinstance(samples, list):
+        raise ValueError('samples must be a list')
+    valid = []
+    for sample in samples[-MAX_BATCH_SAMPLES:]:
+        try:
+            seq, t_client, throttle, steering = sample
+            seq = check_seq(int(seq))
+            t_client, throttle, steering = float(t_client), float(throttle), float(steering)
+        except (TypeError, ValueError, OverflowError):
+            continue
+        if math.isfinite(throttle) and math.isfinite(steering):
+            valid.append((seq, t_client, throttle, steering))
+    if not valid:
+        raise ValueError('no valid samples')
+    seq, t_client, throttle, steering = max(valid)
+    applied = set_joystick(throttle, steering, seq, received, client)
+    if metrics.enabled:
+        note_client_send(t_client)
+        batch_sizes.observe(len(valid))
+        batch_superseded.inc(len(valid) - 1)
+    return applied
+
+def set_armed(armed):
+    global motors_armed
+    with motors_armed_lock:
+        changed = motors_armed != armed
+        motors_armed = armed
+        if shared is not None:
+            shared.write_armed(armed)
+        if recorder is not None:
+            recorder.record(current_command.seq, 0.0, 0.0, armed, arm_event=True)
+    motor_update.set()
+    if changed:
+        for listener in arm_listeners:
+            listener(armed)
+
+def mix(throttle, steering):
+    # Map joystick values to (left, right) motor speeds, all -1 to 1
+    left = max(-1, min(1, throttle + steering))
+    right = max(-1, min(1, throttle - steering))
+    return left, right
+
+def slew(current, target, max_step):
+    if target > current + max_step:
+        return current + max_step
+    if target < current - max_step:
+        return current - max_step
+    return target
+
+def output_changed(applied, speed):
+    # Always honour a stop, otherwise skip changes below OUTPUT_EPSILON
+    if speed == 0:
+        return applied != 0
+    return abs(speed - applied) > OUTPUT_EPSILON
+
+# --- Threads ---
+
+def drive_motor(motor, speed):
+    if speed > 0:
+        motor.forward(speed)
+    elif speed < 0:
+        motor.backward(-speed)
+    else:
+        motor.stop()
+
+def drive_wheels(left_speed, right_speed):
+    # Direct write for callers that do their own timing, like smilebot_cli
+    tables = shaping
+    drive_motor(left_motor, tables.left.lookup(left_speed))
+    drive_motor(right_motor, tables.right.lookup(right_speed))
+    odometry.update(left_speed, right_speed, odometry.clock())
+
+class LocalControl:
+    # Where the motor loop reads its commands and the time from when it
+    # runs in this process. smilebot_shm.SharedControl is the cross-process
+    # equivalent, smilebot_sim.SimControl the virtual time one.
+    now = staticmethod(time.monotonic)
+
+    def read(self):
+        with motors_armed_lock:
+            armed = motors_armed
+        return running, armed, current_command
+
+    def clear(self):
+        motor_update.clear()
+
+    def wait(self, timeout):
+        motor_update.wait(timeout)
+
+    def report(self, stats):
+        pass
+
+class MotorLoop:
+    # One drive unit's slew steps, keepalives and motor writes. step() runs
+    # one pass and says when the next is due; motor_control_loop runs it on
+    # its own thread, smilebot_fleet steps many from one scheduler.
+
+    def __init__(self, stats=None, clock=time.monotonic):
+        self.stats = stats or LoopStats()
+        self.clock = clock  # for timing writes, see step
+        self.configure()
+        self.left_speed = self.right_speed = 0.0  # slew limited output
+        self.applied = None  # (left, right) last written to the motors
+        self.last_write = 0.0
+        self.picked_seq = 0  # the initial Command(0.0, 0.0, 0, 0.0) is never timed
+        self.next_step = None  # deadline of the next slew step, None once settled
+
+    def write(self, left_speed, right_speed, now):
+        tables = shaping
+        drive_motor(left_motor, tables.left.lookup(left_speed))
+        drive_motor(right_motor, tables.right.lookup(right_speed))
+        odometry.update(left_speed, right_speed, now)
+
+    def configure(self):
+        self.settings_version = loop_settings_version
+        self.period = 1.0 / MOTOR_RATE_HZ
+        self.left_step = LEFT_SLEW_RATE * self.period
+        self.right_step = RIGHT_SLEW_RATE * self.period
+
+    def first_step(self, now):
+        # Deadline of the step after the one that starts a ramp
+        return now + self.period
+
+    def step(self, now, armed, command):
+        # Returns the time the next pass is due by, sooner if a command lands
+        if self.settings_version != loop_settings_version:
+            self.configure()
+        stats = self.stats
+        stats.tick(now)
+        pickup = None
+        if command.seq != self.picked_seq:
+            self.picked_seq = command.seq
+            pickup = now
+            stats.pickup(pickup - command.received)
+            if metrics.enabled:
+                publish_to_pickup.observe(pickup - command.received)
+
+        if not armed:
+            self.left_speed = self.right_speed = 0.0
+            self.next_step = None
+        elif self.next_step is None or now >= self.next_step:
+            left_target, right_target = mix(command.throttle, command.steering)
+            self.left_speed = slew(self.left_speed, left_target, self.left_step)
+            self.right_speed = slew(self.right_speed, right_target, self.right_step)
+            if self.left_speed == left_target and self.right_speed == right_target:
+                self.next_step = None
+            elif self.next_step is None:
+                self.next_step = self.first_step(now)
+            else:
+                # Deadlines advance by whole periods so the rate never drifts,
+                # missed steps are counted rather than run late in a burst
+                missed = int((now - self.next_step) / self.period)
+                stats.late(now - self.next_step, missed)
+                if metrics.enabled:
+                    step_lateness.observe(now - self.next_step)
+                self.next_step += (missed + 1) * self.period
+        # else: woken early by a command, it is applied at the next deadline
+
+        applied = self.applied
+        if (applied is None
+                or output_changed(applied[0], self.left_speed)
+                or output_changed(applied[1], self.right_speed)
+                or now - self.last_write >= MOTOR_KEEPALIVE_INTERVAL):
+            self.write(self.left_speed, self.right_speed, now)
+            self.applied = (self.left_speed, self.right_speed)
+            stats.left, stats.right = self.applied
+            self.last_write = now
+            if metrics.enabled:
+                motor_writes.inc()
+                if pickup is not None:
+                    written = self.clock()
+                    pickup_to_write.observe(written - pickup)
+                    command_to_write.observe(written - command.received)
+
+        if self.next_step is None:
+            return now + MOTOR_KEEPALIVE_INTERVAL
+        return self.next_step
+
+def motor_control_loop(control=None):
+    control = control or LocalControl()
+    loop = MotorLoop(loop_stats, control.now)
+    while True:
+        # Clear before reading so an update that lands mid-pass wakes us again
+        control.clear()
+        is_running, armed, command = control.read()
+        if not is_running:
+            break
+        while pin_changes:
+            pin_changes.popleft().run()
+            loop.applied = None  # write the current outputs to the new pins
+        due = loop.step(control.now(), armed, command)
+        control.report(loop.stats)
+        control.wait(max(0.0, due - control.now()))
+
+def check_motor_rate(rate_hz):
+    if not MIN_MOTOR_RATE_HZ <= rate_hz <= MAX_MOTOR_RATE_HZ:
+        raise ValueError('motor rate must be from %g to %g Hz' % (MIN_MOTOR_RATE_HZ, MAX_MOTOR_RATE_HZ))
+    return rate_hz
+
+def set_loop_settings(rate_hz, left_slew_rate, right_slew_rate, keepalive):
+    # Takes effect at the motor loop's next pass. The loop in a motor
+    # process keeps the settings it started with. Raises ValueError for a
+    # rate out of range.
+    global MOTOR_RATE_HZ, LEFT_SLEW_RATE, RIGHT_SLEW_RATE, MOTOR_KEEPALIVE_INTERVAL
+    global loop_settings_version
+    MOTOR_RATE_HZ = check_motor_rate(rate_hz)
+    LEFT_SLEW_RATE = left_slew_rate
+    RIGHT_SLEW_RATE = right_slew_rate
+    MOTOR_KEEPALIVE_INTERVAL = keepalive
+    loop_settings_version += 1
+
+class PinChange:
+    # Moves the motors to new pins from inside the motor loop, which owns
+    # them: stop, release the old pins, claim the new ones, or claim the
+    # old ones back if that fails
+
+    def __init__(self, left_pins, right_pins):
+        self.pins = (dict(left_pins), dict(right_pins))
+        self.done = threading.Event()
+        self.error = None
+
+    def run(self):
+        global left_motor, right_motor, LEFT_MOTOR_PINS, RIGHT_MOTOR_PINS
+        from gpiozero import Motor
+        try:
+            for motor in (left_motor, right_motor):
+                motor.stop()
+                motor.close()
+            try:
+                left_motor = Motor(**self.pins[0])
+                try:
+                    right_motor = Motor(**self.pins[1])
+                except Exception:
+                    left_motor.close()
+                    raise
+                LEFT_MOTOR_PINS, RIGHT_MOTOR_PINS = self.pins
+            except Exception as e:
+                self.error = e
+                left_motor = Motor(**LEFT_MOTOR_PINS)
+                right_motor = Motor(**RIGHT_MOTOR_PINS)
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            self.done.set()
+
+def change_pins(left_pins, right_pins, timeout=2.0):
+    # Disarms, then has the motor loop move the motors to the new pins.
+    # Raises RuntimeError if it could not, the old pins stay in use.
+    if shared is not None:
+        raise RuntimeError('pins cannot change under --motor-process, restart instead')
+    set_armed(False)
+    change = PinChange(left_pins, right_pins)
+    pin_changes.append(change)
+    motor_update.set()
+    if not change.done.wait(timeout):
+        try:
+            pin_changes.remove(change)
+        except ValueError:
+            change.done.wait()  # the loop took it just now
+        else:
+            raise RuntimeError('motor loop did not take the pin change')
+    if change.error is not None:
+        raise RuntimeError('pin change failed, still on the old pins: %s' % change.error)
+
+def read_pose():
+    # The motor loop's latest pose, from whichever process runs it
+    if shared is not None:
+        return shared.read_pose()
+    return odometry.pose
+
+def current_pose():
+    return smilebot_odometry.relative(odometry.estimate(odometry.clock(), read_pose()), pose_origin)
+
+def reset_pose():
+    # Makes the current pose the origin
+    global pose_origin
+    pose_origin = odometry.estimate(odometry.clock(), read_pose())
+
+# Control channel frames are short comma separated strings so the phone
+# doesn't pay for JSON on every stick move:
+#   j,<id>,<throttle>,<steering>[,<t_client>]   joystick
+#   a,<id>,<0|1>                                arm / disarm
+# Every frame is answered with k,<id>,<send_hz> so the page can time the
+# round trip and keep to the send rate, see SendRate.
+# Frame ids share the page's command sequence, see set_joystick().
+# Returns the reply frame, or None for a frame too mangled to answer.
+def handle_control_frame(message, client=None):
+    # client is the page's id, or the connection when it sent none
+    received = time.monotonic() if metrics.enabled else None
+    try:
+        kind, frame_id, *values = message.split(',')
+    except ValueError:
+        return None
+    if kind == 'j':
+        try:
+            set_joystick(float(values[0]), float(values[1]), int(frame_id), received, client)
+            if metrics.enabled and len(values) > 2:
+                note_client_send(float(values[2]))
+        except (IndexError, ValueError):
+            set_joystick(0.0, 0.0, client=client)
+    elif kind == 'a':
+        set_armed(values[:1] == ['1'])
+    return 'k,%s,%d' % (frame_id, send_rate.check())
+
+# --- Backing off for the motor loop ---
+
+# Work that shares the Pi with the motor loop (video frames, the page's
+# send rate) backs off sharply on an interval where the loop ran late and
+# creeps back up after a run of healthy ones. Slew steps only run while
+# outputs ramp, so how long new commands waited for the loop to wake counts
+# too: that is what a starved CPU delays while the outputs are settled.
+LATENESS_BUDGET = 0.25  # mean slew step lateness, as a share of the step period
+PICKUP_BUDGET = 0.005  # mean command publish to pickup, seconds, one GIL switch interval
+
+def loop_late(steps, lateness_sum, overruns, pickups=0, pickup_sum=0.0):
+    # From LoopStats differences over an interval: were slew steps missed,
+    # late on average past LATENESS_BUDGET, or commands picked up late on
+    # average past PICKUP_BUDGET?
+    return (bool(overruns)
+            or (steps > 0 and lateness_sum / steps > LATENESS_BUDGET / MOTOR_RATE_HZ)
+            or (pickups > 0 and pickup_sum / pickups > PICKUP_BUDGET))
+
+class Backoff:
+    # update() says which way to move a setting after each interval: -1 to
+    # back off, 1 to step back up after recover_after healthy intervals in
+    # a row, 0 to hold
+
+    def __init__(self, recover_after):
+        self.recover_after = recover_after
+        self.healthy_intervals = 0
+
+    def update(self, degraded):
+        if degraded:
+            self.healthy_intervals = 0
+            return -1
+        self.healthy_intervals += 1
+        return 1 if self.healthy_intervals >= self.recover_after else 0
+
+# --- Client send rate ---
+
+# The page sends stick updates at most send_rate.hz times a second, read
+# from telemetry, control socket acks and batch replies. Whenever one of
+# those asks, at most once per SEND_ADAPT_INTERVAL, the rate is checked
+# against how the server coped since: commands replaced before the motor
+# loop picked them up (the backlog), and slew steps run late or missed.
+# Under load it halves, then creeps back up while things stay healthy, as
+# the video frame rate does.
+SEND_HZ = 30
+MIN_SEND_HZ = 4
+SEND_ADAPT_INTERVAL = 1.0
+SEND_RECOVER_AFTER = 3  # healthy intervals before stepping back up
+SEND_BACKLOG_BUDGET = 0.25  # share of accepted commands the loop never saw
+
+class SendRate:
+
+    def __init__(self, max_hz=SEND_HZ, clock=time.monotonic):
+        self.max_hz = self.hz = max_hz
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.next_adapt = 0.0
+        self.backoff = Backoff(SEND_RECOVER_AFTER)
+        self.last = None
+        # Over the last interval, see adapt
+        self.load = {'backlog': 0, 'overruns': 0, 'lateness_ms': 0.0, 'pickup_ms': 0.0}
+
+    def counts(self):
+        stats = read_loop_stats()
+        return (commands_accepted, stats.pickups, stats.pickup_sum,
+                stats.steps, stats.lateness_sum, stats.overruns)
+
+    def check(self):
+        # Returns the target rate, adapting it first when due. Cheap enough
+        # for every ack: one clock read until the interval is up.
+        now = self.clock()
+        if now < self.next_adapt or not self.lock.acquire(blocking=False):
+            return self.hz
+        try:
+            self.next_adapt = now + SEND_ADAPT_INTERVAL
+            counts = self.counts()
+            if self.last is not None:
+                self.adapt(*(new - old for new, old in zip(counts, self.last)))
+            self.last = counts
+        finally:
+            self.lock.release()
+        return self.hz
+
+    def adapt(self, accepted, pickups, pickup_sum, steps, lateness_sum, overruns):
+        backlog = max(0, accepted - pickups)
+        lateness = lateness_sum / steps if steps else 0.0
+        self.load = {
+            'backlog': backlog,
+            'overruns': overruns,
+            'lateness_ms': round(lateness * 1000, 3),
+            'pickup_ms': round(pickup_sum / pickups * 1000, 3) if pickups else 0.0,
+        }
+        move = self.backoff.update(loop_late(steps, lateness_sum, overruns, pickups, pickup_sum)
+                                   or backlog > SEND_BACKLOG_BUDGET * accepted)
+        if move < 0:
+            self.hz = max(MIN_SEND_HZ, self.hz // 2)
+        elif move > 0:
+            self.hz = min(self.max_hz, self.hz + 2)
+
+send_rate = SendRate()
+metrics.gauge('smilebot_client_send_hz', 'Stick update rate the page is asked to keep to',
+              lambda: send_rate.hz)
+
+# /telemetry streams what the motors are actually doing as Server-Sent
+# Events, at most TELEMETRY_HZ per client and once a second when nothing
+# moves. Each stream takes a fresh snapshot only when its client has taken
+# the last one, so a slow client skips values instead of building a backlog.
+TELEMETRY_HZ = 20
+TELEMETRY_INTERVAL = 1.0 / TELEMETRY_HZ
+TELEMETRY_KEEPALIVE = 1.0
+
+def telemetry():
+    stats = read_loop_stats()
+    command = current_command
+    return {
+        'left': round(stats.left, 3),
+        'right': round(stats.right, 3),
+        'armed': motors_armed,
+        'period_ms': round(stats.period_last * 1000, 2),
+        'age_ms': round((time.monotonic() - command.received) * 1000) if command.seq else None,
+        'seq': command.seq,
+        'send_hz': send_rate.check(),
+        'load': send_rate.load,
+    }
+
+class TelemetryStream:
+
+    def __init__(self):
+        self.last = None
+        self.last_sent = 0.0
+
+    def poll(self):
+        # Returns the next SSE event, or None if there is nothing new yet
+        snapshot = telemetry()
+        state = (snapshot['left'], snapshot['right'], snapshot['armed'], snapshot['seq'],
+                 snapshot['send_hz'])
+        now = time.monotonic()
+        if state == self.last and now - self.last_sent < TELEMETRY_KEEPALIVE:
+            return None
+        self.last = state
+        self.last_sent = now
+        return 'data: %s\n\n' % json.dumps(snapshot, separators=(',', ':'))
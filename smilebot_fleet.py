@@ -0,0 +1,320 @@
+"""Drive several robots from one process: one scheduler, one web server.
+
+Each drive unit in the config gets its own pins, command, arm state,
+shaping and odometry, plus its own core.MotorLoop for slew steps and
+keepalives. A single scheduler thread steps them all: a heap holds each
+unit's next due time, and a command or arm change queues its unit to be
+stepped straight away, so the scheduler only ever touches units that have
+something to do and N units never need N threads.
+
+    python3 smilebot_fleet.py fleet.json --port 5000
+
+    {"units": [
+        {"id": "alpha",
+         "left": {"forward": 23, "backward": 22, "enable": 13},
+         "right": {"forward": 17, "backward": 27, "enable": 12}},
+        {"id": "bravo",
+         "left": {"forward": 5, "backward": 6, "enable": 19},
+         "right": {"forward": 20, "backward": 21, "enable": 18},
+         "shaping": {"left": {"gain": 0.9}}}]}
+
+Routes, per unit, take the same forms as the single robot servers:
+
+    GET       /robots                  status of every unit
+    GET       /robot/<id>              status of one
+    POST      /robot/<id>/joystick     throttle, steering, seq, client
+    POST      /robot/<id>/arm          state=true|false
+    GET/POST  /robot/<id>/pose         POST resets it
+    GET       /metrics
+    GET       /debug/profile?seconds=N with SMILEBOT_PROFILE=1
+    POST      /shutdown
+
+See bench_fleet.py for how the scheduler scales with the number of units.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+import smilebot_config
+import smilebot_core as core
+import smilebot_metrics as metrics
+import smilebot_odometry
+import smilebot_profile
+import smilebot_shaping
+
+class DriveUnit(core.MotorLoop):
+
+    def __init__(self, unit_id, left_pins, right_pins, shaping=None, clock=time.monotonic):
+        super().__init__(core.LoopStats(), clock)
+        self.id = unit_id
+        self.left_pins = left_pins
+        self.right_pins = right_pins
+        self.left_motor = self.right_motor = None
+        self.shaping = shaping or smilebot_shaping.compile_shaping()
+        self.odometry = smilebot_odometry.Odometry(clock)
+        self.pose_origin = smilebot_odometry.ORIGIN
+        # Written under lock by request threads, read lock-free by the
+        # scheduler, as with core.current_command
+        self.command = core.Command(0.0, 0.0, 0, 0.0)
+        self.armed = False
+        self.lock = threading.Lock()
+        self.client_seqs = core.ClientSeqs()
+        self.notify = None  # set by Fleet, queues this unit for a step
+        self.due = None  # when the scheduler will step it next
+
+    def init_motors(self):
+        from gpiozero import Motor
+        self.left_motor = Motor(**self.left_pins)
+        self.right_motor = Motor(**self.right_pins)
+
+    def write(self, left_speed, right_speed, now):
+        tables = self.shaping
+        core.drive_motor(self.left_motor, tables.left.lookup(left_speed))
+        core.drive_motor(self.right_motor, tables.right.lookup(right_speed))
+        self.odometry.update(left_speed, right_speed, now)
+
+    def first_step(self, now):
+        # Ramps step on a grid of whole periods shared by every unit, so the
+        # scheduler wakes once for all the units due together instead of
+        # once per unit at scattered times
+        return (now // self.period + 1) * self.period
+
+    def set_joystick(self, throttle, steering, seq=None, client=None):
+        # Same rules as core.set_joystick: returns False for a seq stale for
+        # its client, raises ValueError for one out of range
+        if seq is not None:
+            core.check_seq(seq)
+        throttle = self.shaping.throttle.lookup(throttle)
+        steering = self.shaping.steering.lookup(steering)
+        with self.lock:
+            if seq is not None and not self.client_seqs.accept(client, seq):
+                if metrics.enabled:
+                    core.commands_stale.inc()
+                return False
+            self.command = core.Command(throttle, steering, self.command.seq + 1, self.clock())
+        self.notify(self)
+        return True
+
+    def set_armed(self, armed):
+        with self.lock:
+            self.armed = armed
+        self.notify(self)
+
+    def stop(self):
+        for motor in (self.left_motor, self.right_motor):
+            try:
+                motor.stop()
+            except Exception:
+                pass
+
+    def current_pose(self):
+        pose = self.odometry.estimate(self.clock())
+        return smilebot_odometry.relative(pose, self.pose_origin)
+
+    def reset_pose(self):
+        self.pose_origin = self.odometry.estimate(self.clock())
+
+    def status(self):
+        stats = self.stats
+        command = self.command
+        return {
+            'id': self.id,
+            'armed': self.armed,
+            'left': round(stats.left, 3),
+            'right': round(stats.right, 3),
+            'seq': command.seq,
+            'age_ms': round((self.clock() - command.received) * 1000) if command.seq else None,
+            'overruns': stats.overruns,
+            'lateness_max_ms': round(stats.lateness_max * 1000, 3),
+            'pose': smilebot_odometry.pose_dict(self.current_pose()),
+        }
+
+class Fleet:
+
+    def __init__(self, units, clock=time.monotonic):
+        self.units = {}
+        for unit in units:
+            if unit.id in self.units:
+                raise ValueError('duplicate unit id %r' % unit.id)
+            self.units[unit.id] = unit
+            unit.notify = self.notify
+        self.clock = clock
+        self.running = True
+        self.wake = threading.Event()
+        self.pending = deque()  # units with a new command or arm state
+        self.passes = 0  # scheduler wake ups
+        self.steps = 0  # unit steps run
+
+    def notify(self, unit):
+        self.pending.append(unit)
+        self.wake.set()
+
+    def run(self):
+        # The scheduler: steps each unit when it is due or has news. Heap
+        # entries go stale when a queued step moves a unit's due time, and
+        # are skipped when they no longer match it.
+        heap = []
+        tiebreak = itertools.count()  # units themselves don't compare
+
+        def step(unit, now):
+            self.steps += 1
+            due = unit.step(now, unit.armed, unit.command)
+            if due != unit.due:
+                unit.due = due
+                heapq.heappush(heap, (due, next(tiebreak), unit))
+
+        now = self.clock()
+        for unit in self.units.values():
+            step(unit, now)
+        while self.running:
+            # Clear before draining so news that lands mid-pass wakes us again
+            self.wake.clear()
+            self.passes += 1
+            now = self.clock()
+            while self.pending:
+                step(self.pending.popleft(), now)
+            while heap and heap[0][0] <= now:
+                due, _, unit = heapq.heappop(heap)
+                if due == unit.due:
+                    step(unit, now)
+            self.wake.wait(max(0.0, heap[0][0] - self.clock()) if heap else None)
+        for unit in self.units.values():
+            unit.stop()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+def load_units(config, clock=time.monotonic):
+    # DriveUnits from a parsed fleet config, raises ValueError if it is
+    # invalid, including two units sharing a pin
+    units = config.get('units') if isinstance(config, dict) else None
+    if not isinstance(units, list) or not units:
+        raise ValueError('config needs a non-empty "units" list')
+    result = []
+    owners = {}
+    for i, entry in enumerate(units):
+        unit_id = entry.get('id') if isinstance(entry, dict) else None
+        if not isinstance(unit_id, str) or not unit_id or '/' in unit_id:
+            raise ValueError('unit %d needs an "id" string without "/"' % i)
+        left = smilebot_config.check_pins(entry.get('left'), '%s.left' % unit_id)
+        right = smilebot_config.check_pins(entry.get('right'), '%s.right' % unit_id)
+        for pin in list(left.values()) + list(right.values()):
+            if pin in owners:
+                raise ValueError('GPIO %d is used by both %s and %s' % (pin, owners[pin], unit_id))
+            owners[pin] = unit_id
+        shaping = smilebot_shaping.compile_shaping(entry.get('shaping'))
+        result.append(DriveUnit(unit_id, left, right, shaping, clock))
+    return result
+
+def read_config(path):
+    # Raises OSError or ValueError
+    with open(path) as f:
+        return load_units(json.load(f))
+
+fleet = None  # the running Fleet, for the metrics below
+
+metrics.gauge('smilebot_fleet_units', 'Drive units in the fleet',
+              lambda: len(fleet.units) if fleet else 0)
+metrics.gauge('smilebot_fleet_steps', 'Unit steps run by the fleet scheduler',
+              lambda: fleet.steps if fleet else 0)
+metrics.gauge('smilebot_fleet_overruns', 'Scheduled steps missed, all units',
+              lambda: sum(u.stats.overruns for u in fleet.units.values()) if fleet else 0)
+metrics.gauge('smilebot_fleet_lateness_max', 'Worst step wake up after its deadline, any unit, seconds',
+              lambda: max(u.stats.lateness_max for u in fleet.units.values()) if fleet else 0.0)
+
+def create_app():
+    from flask import Flask, Response, abort, jsonify, request
+    app = Flask(__name__, static_folder=None)
+
+    def unit_or_404(unit_id):
+        unit = fleet.units.get(unit_id)
+        if unit is None:
+            abort(404)
+        return unit
+
+    @app.route('/robots')
+    def robots():
+        return jsonify([unit.status() for unit in fleet.units.values()])
+
+    @app.route('/robot/<unit_id>')
+    def robot(unit_id):
+        return jsonify(unit_or_404(unit_id).status())
+
+    @app.route('/robot/<unit_id>/joystick', methods=['POST'])
+    def joystick(unit_id):
+        unit = unit_or_404(unit_id)
+        client = core.client_id(request.form.get('client'))
+        try:
+            throttle = float(request.form.get('throttle', 0.0))
+            steering = float(request.form.get('steering', 0.0))
+            unit.set_joystick(throttle, steering, request.form.get('seq', type=int), client)
+        except Exception:
+            unit.set_joystick(0.0, 0.0, client=client)
+        return 'OK'
+
+    @app.route('/robot/<unit_id>/arm', methods=['POST'])
+    def arm(unit_id):
+        unit_or_404(unit_id).set_armed(request.form.get('state') == 'true')
+        return 'OK'
+
+    @app.route('/robot/<unit_id>/pose', methods=['GET', 'POST'])
+    def pose(unit_id):
+        unit = unit_or_404(unit_id)
+        if request.method == 'POST':
+            unit.reset_pose()
+        return jsonify(smilebot_odometry.pose_dict(unit.current_pose()))
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        if request.args.get('format') == 'json':
+            return jsonify(metrics.render_json())
+        return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/debug/profile')
+    def debug_profile():
+        # Collapsed stacks of every thread over ?seconds=, see smilebot_profile
+        status, content_type, body = smilebot_profile.respond(request.args.get('seconds'))
+        return Response(body, status=status, mimetype=content_type)
+
+    @app.route('/shutdown', methods=['POST'])
+    def shutdown():
+        fleet.stop()
+        for unit in fleet.units.values():
+            unit.stop()
+        os._exit(0)
+
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve several drive units from one process")
+    parser.add_argument('config', help="fleet config, see the module docstring")
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--motor-rate', type=float, default=core.MOTOR_RATE_HZ,
+                        help="step rate in Hz while a unit's outputs are ramping")
+    args = parser.parse_args()
+    try:
+        core.MOTOR_RATE_HZ = core.check_motor_rate(args.motor_rate)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        fleet = Fleet(read_config(args.config))
+    except (OSError, ValueError) as e:
+        raise SystemExit("Bad fleet config: %s" % e)
+    app = create_app()
+    scheduler = threading.Thread(target=fleet.run, name='fleet-scheduler', daemon=True)
+    try:
+        for unit in fleet.units.values():
+            unit.init_motors()
+        scheduler.start()
+        print("Driving %d units: %s" % (len(fleet.units), ', '.join(fleet.units)))
+        app.run(host='0.0.0.0', port=args.port, debug=False, use_reloader=False, threaded=True)
+    except KeyboardInterrupt:
+        print("\nProgram interrupted by user. Exiting...")
+    finally:
+        fleet.stop()
+        scheduler.join(timeout=2.0)
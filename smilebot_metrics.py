@@ -0,0 +1,134 @@
+"""Fixed size latency histograms and counters for the control server.
+
+Histograms keep cumulative bucket counts for Prometheus plus a ring buffer
+of recent samples for the percentiles in the JSON view, so memory never
+grows. Hot paths check ``enabled`` before reading a clock, which keeps a
+disabled build down to one attribute lookup per call site.
+"""
+import os
+import threading
+from array import array
+from bisect import bisect_left
+
+enabled = os.environ.get('SMILEBOT_METRICS', '0') not in ('', '0', 'false')
+
+# Upper bounds in seconds, shared by every latency histogram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+RECENT_SAMPLES = 512
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = array('d', bytes(8 * RECENT_SAMPLES))
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.recent[self.count % RECENT_SAMPLES] = value
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantiles(self, *qs):
+        with self.lock:
+            samples = sorted(self.recent[:min(self.count, RECENT_SAMPLES)])
+        if not samples:
+            return [None] * len(qs)
+        return [samples[min(len(samples) - 1, int(q * len(samples)))] for q in qs]
+
+    def prometheus(self):
+        lines = []
+        total = 0
+        with self.lock:
+            counts, count, total_sum = list(self.counts), self.count, self.sum
+        for bound, bucket_count in zip(self.buckets, counts):
+            total += bucket_count
+            lines.append('%s_bucket{le="%g"} %d' % (self.name, bound, total))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, count))
+        lines.append('%s_sum %.9f' % (self.name, total_sum))
+        lines.append('%s_count %d' % (self.name, count))
+        return lines
+
+    def as_dict(self):
+        p50, p90, p99 = self.quantiles(0.5, 0.9, 0.99)
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': p50, 'p90': p90, 'p99': p99}
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def prometheus(self):
+        return ['%s %d' % (self.name, self.value)]
+
+    def as_dict(self):
+        return self.value
+
+class Gauge:
+    # Value read on demand from a callback, for state that already lives
+    # somewhere else and shouldn't be copied on the hot path
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def prometheus(self):
+        return ['%s %s' % (self.name, self.read())]
+
+    def as_dict(self):
+        return self.read()
+
+def _register(cls, name, help_text, *args):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, help_text, *args)
+        return metric
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help_text, buckets)
+
+def counter(name, help_text):
+    return _register(Counter, name, help_text)
+
+def gauge(name, help_text, read):
+    return _register(Gauge, name, help_text, read)
+
+def render_prometheus():
+    lines = ['# HELP smilebot_metrics_enabled Whether hot path timing is on',
+             '# TYPE smilebot_metrics_enabled gauge',
+             'smilebot_metrics_enabled %d' % enabled]
+    for metric in list(_registry.values()):
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        lines.extend(metric.prometheus())
+    return '\n'.join(lines) + '\n'
+
+def render_json():
+    return {'enabled': enabled,
+            'metrics': {m.name: m.as_dict() for m in list(_registry.values())}}
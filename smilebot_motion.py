@@ -0,0 +1,149 @@
+"""Timed motion programs for smilebot_cli.py.
+
+A program is plain text, one segment per line, using the CLI's keys:
+
+    # key  seconds  power%
+    w 1.5 60      forward
+    a 0.4 50      turn left
+    s 1.0 60      backward
+    d 0.4 50      turn right
+    x 0.5         stop and hold (power optional)
+
+Blank lines and anything after '#' are ignored. Every segment is checked
+before it is scheduled. MotionEngine runs segments back to back on
+absolute monotonic deadlines, switching straight from one motion to the
+next with no stop in between, and can be aborted mid-segment from any
+thread.
+"""
+import queue
+import threading
+import time
+from collections import namedtuple
+
+COMMANDS = {
+    'w': 'forward',
+    's': 'backward',
+    'a': 'left',
+    'd': 'right',
+    'x': 'stop',
+}
+MAX_SEGMENT_SECONDS = 600.0
+# A segment that starts this late has lost its slot (the input stalled),
+# so the schedule restarts from now instead of cutting the segment short
+RESCHEDULE_AFTER = 0.05
+
+Segment = namedtuple('Segment', 'command duration power line')
+
+class MotionError(ValueError):
+    pass
+
+def parse_segment(text, line=None):
+    # Returns a Segment, None for a blank/comment line, or raises MotionError
+    where = 'line %d: ' % line if line is not None else ''
+    fields = text.split('#', 1)[0].split()
+    if not fields:
+        return None
+    command = fields[0].lower()
+    if command not in COMMANDS:
+        raise MotionError("%sunknown command %r, expected one of %s"
+                          % (where, fields[0], ' '.join(COMMANDS)))
+    if len(fields) not in (2, 3) or (len(fields) == 2 and command != 'x'):
+        raise MotionError("%sexpected '<command> <seconds> <power%%>'" % where)
+    try:
+        duration = float(fields[1])
+        power = float(fields[2]) / 100.0 if len(fields) == 3 else 0.0
+    except ValueError:
+        raise MotionError("%sseconds and power must be numbers" % where)
+    if not 0 < duration <= MAX_SEGMENT_SECONDS:
+        raise MotionError("%sseconds must be between 0 and %g" % (where, MAX_SEGMENT_SECONDS))
+    if not 0 <= power <= 1:
+        raise MotionError("%spower must be between 0 and 100" % where)
+    return Segment(command, duration, power, line)
+
+def parse_program(lines):
+    # Parses a whole program up front so a typo on the last line is caught
+    # before the robot moves. Raises MotionError.
+    segments = []
+    for number, text in enumerate(lines, 1):
+        segment = parse_segment(text, number)
+        if segment is not None:
+            segments.append(segment)
+    return segments
+
+class MotionEngine:
+    # drive(command, power) sets the motors for one of COMMANDS and must
+    # return quickly, the engine does all the waiting. wait(timeout) returns
+    # True if the run was aborted, swap it with clock for virtual time.
+
+    def __init__(self, drive, clock=time.monotonic, wait=None):
+        self.drive = drive
+        self.clock = clock
+        self.aborted = threading.Event()
+        self.wait = wait or self.aborted.wait
+
+    def abort(self):
+        self.aborted.set()
+
+    def run(self, segments):
+        # Runs an iterable of segments, returns True if it ran to the end
+        self.aborted.clear()
+        deadline = None
+        try:
+            for segment in segments:
+                now = self.clock()
+                # Deadlines chain so timing never drifts, unless the next
+                # segment arrived late and there is no schedule to keep
+                if deadline is None or now - deadline > RESCHEDULE_AFTER:
+                    deadline = now
+                self.drive(segment.command, segment.power)
+                deadline += segment.duration
+                if self.wait(max(0.0, deadline - self.clock())):
+                    return False
+            return True
+        finally:
+            self.drive('stop', 0.0)
+
+    def run_stream(self, lines):
+        # Runs segments as lines arrive, e.g. from stdin. A reader thread
+        # parses ahead so the next segment starts right on the deadline;
+        # if none is ready by then the robot stops until one is. A bad line
+        # aborts the run and raises MotionError.
+        ready = queue.Queue()
+        done = object()
+
+        def reader():
+            try:
+                for number, text in enumerate(lines, 1):
+                    segment = parse_segment(text, number)
+                    if segment is not None:
+                        ready.put(segment)
+            except MotionError as e:
+                ready.put(e)
+            finally:
+                ready.put(done)
+
+        threading.Thread(target=reader, daemon=True).start()
+
+        def segments():
+            while True:
+                try:
+                    item = ready.get_nowait()
+                except queue.Empty:
+                    # Nothing queued yet: stop and hold until there is
+                    self.drive('stop', 0.0)
+                    item = None
+                    while item is None and not self.aborted.is_set():
+                        try:
+                            item = ready.get(timeout=0.1)
+                        except queue.Empty:
+                            pass
+                    if item is None:
+                        return
+                if item is done:
+                    return
+                if isinstance(item, MotionError):
+                    self.abort()
+                    raise item
+                yield item
+
+        return self.run(segments())
@@ -0,0 +1,159 @@
+"""Dead reckoning: where the robot has got to from the wheel speeds it was given.
+
+The motor loop (and smilebot_cli, through core.drive_wheels) calls
+Odometry.update with the speeds it writes. Between changes the wheels are
+taken to turn at a constant speed, so the robot drives an exact arc, and an
+update only has to integrate that one arc: O(1) however long it has been.
+Updates that do not change the speeds do nothing at all, and the pose at any
+later time is the last one carried forward along its arc, see estimate().
+
+Poses are immutable Pose tuples swapped in whole, like core.Command, so
+another thread can read odometry.pose without a lock. x is forward at
+heading 0, y to the left, heading in radians counterclockwise.
+
+There are no encoders, so this drifts: motor lag, slip and the difference
+between a PWM duty cycle and a real wheel speed all go uncorrected.
+smilebot_sim shares the same geometry and models the lag, so a simulated
+run shows how far off the estimate gets.
+
+trajectory() is the same integration vectorized with numpy, for
+reconstructing hours of recorded driving in one pass:
+
+    python3 smilebot_odometry.py session.bin --csv track.csv
+"""
+import argparse
+import math
+import time
+from collections import namedtuple
+
+# Rough numbers for the TT gear motors on the chassis, tune to taste
+FULL_SPEED = 0.6  # m/s of wheel surface at speed 1
+TRACK_WIDTH = 0.14  # m between the wheels
+# The wheels turn forward for negative speeds with this wiring, see the
+# WHEELS table in smilebot_cli
+FORWARD_SIGN = -1
+
+# time is when the pose was reached; left and right are the wheel speeds
+# from then on
+Pose = namedtuple('Pose', 'time x y heading distance left right')
+ORIGIN = Pose(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+def body_velocity(left, right, full_speed=FULL_SPEED, track_width=TRACK_WIDTH):
+    # (m/s forward, radians/s counterclockwise), also works on numpy arrays
+    scale = FORWARD_SIGN * full_speed
+    return scale * (left + right) / 2, scale * (right - left) / track_width
+
+def arc(x, y, heading, v, w, dt):
+    # Exact arc for constant v and w over dt, returns (x, y, heading). The
+    # chord is written with sin(a)/a so it is stable as w goes to zero.
+    half = w * dt / 2
+    chord = v * dt * (math.sin(half) / half if half else 1.0)
+    middle = heading + half
+    return x + chord * math.cos(middle), y + chord * math.sin(middle), heading + 2 * half
+
+def advance(pose, t, left, right, full_speed=FULL_SPEED, track_width=TRACK_WIDTH):
+    # pose carried forward to t, with new wheel speeds from then on
+    dt = t - pose.time
+    if dt <= 0 or (pose.left == 0 and pose.right == 0):
+        return Pose(max(t, pose.time), pose.x, pose.y, pose.heading, pose.distance, left, right)
+    v, w = body_velocity(pose.left, pose.right, full_speed, track_width)
+    x, y, heading = arc(pose.x, pose.y, pose.heading, v, w, dt)
+    return Pose(t, x, y, heading, pose.distance + abs(v) * dt, left, right)
+
+def relative(pose, origin):
+    # pose as seen from origin, for resetting without touching the loop's state
+    dx, dy = pose.x - origin.x, pose.y - origin.y
+    c, s = math.cos(origin.heading), math.sin(origin.heading)
+    return pose._replace(x=c * dx + s * dy, y=c * dy - s * dx, heading=pose.heading - origin.heading,
+                         distance=pose.distance - origin.distance)
+
+def pose_dict(pose):
+    return {'x': round(pose.x, 4), 'y': round(pose.y, 4),
+            'heading': round(math.degrees(pose.heading) % 360, 2),
+            'distance': round(pose.distance, 4),
+            'left': round(pose.left, 3), 'right': round(pose.right, 3)}
+
+class Odometry:
+
+    def __init__(self, clock=time.monotonic, full_speed=FULL_SPEED, track_width=TRACK_WIDTH):
+        self.clock = clock  # for callers without a time of their own, see core.drive_wheels
+        self.full_speed = full_speed
+        self.track_width = track_width
+        self.pose = ORIGIN
+
+    def update(self, left, right, now):
+        # The wheels turn at left, right from now on
+        pose = self.pose
+        if left != pose.left or right != pose.right:
+            self.pose = advance(pose, now, left, right, self.full_speed, self.track_width)
+
+    def estimate(self, now, pose=None):
+        # The pose at now, from self.pose or one read elsewhere (shared memory)
+        pose = pose or self.pose
+        return advance(pose, now, pose.left, pose.right, self.full_speed, self.track_width)
+
+# --- Batch ---
+
+def trajectory(times, left, right, full_speed=FULL_SPEED, track_width=TRACK_WIDTH):
+    # times, left and right are equal length 1-D arrays, each pair of speeds
+    # held until the next time. Returns numpy arrays (x, y, heading,
+    # distance), the pose at each time starting from the origin.
+    import numpy as np
+    times = np.asarray(times, dtype=float)
+    dt = np.diff(times)
+    v, w = body_velocity(np.asarray(left, dtype=float)[:-1], np.asarray(right, dtype=float)[:-1],
+                         full_speed, track_width)
+    turn = w * dt
+    heading = np.concatenate(([0.0], np.cumsum(turn)))
+    # np.sinc(x) is sin(pi x) / (pi x), so this is arc()'s chord
+    chord = v * dt * np.sinc(turn / (2 * np.pi))
+    middle = heading[:-1] + turn / 2
+    x = np.concatenate(([0.0], np.cumsum(chord * np.cos(middle))))
+    y = np.concatenate(([0.0], np.cumsum(chord * np.sin(middle))))
+    distance = np.concatenate(([0.0], np.cumsum(np.abs(v) * dt)))
+    return x, y, heading, distance
+
+def session_wheels(records, shaping=None):
+    # (times, left, right) arrays from smilebot_record.read_array output,
+    # shaped and mixed as core would with the given compiled shaping. Slew
+    # limiting is left out: at the default 4/s it moves each change by at
+    # most a quarter of a second.
+    import numpy as np
+    import smilebot_record
+    import smilebot_shaping
+    shaping = shaping or smilebot_shaping.compile_shaping()
+    arm_event = (records['flags'] & smilebot_record.ARM_EVENT) != 0
+    armed = (records['flags'] & smilebot_record.ARMED) != 0
+    # Arm changes carry no sticks, the command before them still stands
+    # (arm events record centred sticks, so one before any stick reads as 0)
+    last_stick = np.maximum.accumulate(np.where(arm_event, 0, np.arange(len(records))))
+    throttle = shaping.throttle.lookup_array(records['throttle'][last_stick] / smilebot_record.SCALE)
+    steering = shaping.steering.lookup_array(records['steering'][last_stick] / smilebot_record.SCALE)
+    left = np.where(armed, np.clip(throttle + steering, -1, 1), 0.0)
+    right = np.where(armed, np.clip(throttle - steering, -1, 1), 0.0)
+    return records['time'], left, right
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Dead reckon a recorded session")
+    parser.add_argument('path', help="a smilebot_record session log, rotated files are included")
+    parser.add_argument('--shaping', metavar='FILE', help="the shaping config the session ran with")
+    parser.add_argument('--csv', metavar='FILE', help="write time,x,y,heading,distance per record")
+    args = parser.parse_args()
+    import numpy as np
+    import smilebot_record
+    import smilebot_shaping
+    shaping = smilebot_shaping.compile_shaping(
+        smilebot_shaping.read_config(args.shaping) if args.shaping else None)
+    records = smilebot_record.read_array(args.path)
+    if len(records) == 0:
+        raise SystemExit("No records in %s" % args.path)
+    started = time.perf_counter()
+    times, left, right = session_wheels(records, shaping)
+    x, y, heading, distance = trajectory(times, left, right)
+    elapsed = time.perf_counter() - started
+    print('pose', pose_dict(Pose(*(float(a[-1]) for a in (times, x, y, heading, distance,
+                                                          left, right)))))
+    print('%d records over %.1f s in %.3f s' % (len(records), times[-1] - times[0], elapsed))
+    if args.csv:
+        np.savetxt(args.csv, np.column_stack((times, x, y, np.degrees(heading) % 360, distance)),
+                   fmt='%.6f', delimiter=',', header='time,x,y,heading,distance', comments='')
@@ -0,0 +1,106 @@
+"""Control page and static assets, compressed and hashed once at startup.
+
+Each CompiledAsset keeps identity, gzip and (when the brotli package is
+installed) br bodies plus a strong ETag, so serving a request is a dict
+lookup instead of template rendering or file IO.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:  # gzip alone is fine, brotli just saves a few more bytes
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
+
+# The page itself is revalidated every load (a 304 costs almost nothing),
+# assets are linked with ?v=<hash> so they can be cached forever.
+PAGE_CACHE_CONTROL = 'no-cache'
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class CompiledAsset:
+
+    def __init__(self, body, content_type, cache_control=PAGE_CACHE_CONTROL):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        digest = hashlib.sha1(body).hexdigest()
+        self.version = digest[:10]
+        self.etag = '"%s"' % digest[:16]
+        self.variants = {'identity': body}
+        compressed = gzip.compress(body, 9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.variants['br'] = compressed
+
+    def negotiate(self, accept_encoding):
+        # Returns (content_encoding, body) for an Accept-Encoding header
+        accepted = set()
+        for part in (accept_encoding or '').split(','):
+            coding, _, params = part.partition(';')
+            params = params.replace(' ', '')
+            if params.startswith('q='):
+                try:
+                    if float(params[2:]) <= 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(coding.strip().lower())
+        for coding in ('br', 'gzip'):
+            if coding in self.variants and (coding in accepted or '*' in accepted):
+                return coding, self.variants[coding]
+        return 'identity', self.variants['identity']
+
+    def not_modified(self, if_none_match):
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or self.etag in tags or 'W/' + self.etag in tags
+
+    def headers(self, coding, cache_control=None):
+        headers = {
+            'ETag': self.etag,
+            'Cache-Control': cache_control or self.cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if coding != 'identity':
+            headers['Content-Encoding'] = coding
+        return headers
+
+def compile_static(directory=STATIC_DIR):
+    # {'js/thumbstick.js': CompiledAsset, ...} for every file under directory
+    assets = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, directory).replace(os.sep, '/')
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            if content_type.startswith('text/') or content_type.endswith('javascript'):
+                content_type += '; charset=utf-8'
+            with open(path, 'rb') as f:
+                assets[relpath] = CompiledAsset(f.read(), content_type, ASSET_CACHE_CONTROL)
+    return assets
+
+def asset_urls(assets):
+    # Template helper: asset_url('js/thumbstick.js') -> versioned URL
+    def asset_url(name):
+        return '/static/%s?v=%s' % (name, assets[name].version)
+    return asset_url
+
+def compile_page(html):
+    return CompiledAsset(html.encode('utf-8'), 'text/html; charset=utf-8')
+
+def compile_control_panel(assets):
+    # Plain jinja2 rather than Flask's render_template so every server
+    # mode renders the same page
+    import jinja2
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), autoescape=True)
+    template = env.get_template('control_panel.html')
+    return compile_page(template.render(asset_url=asset_urls(assets)))
@@ -0,0 +1,122 @@
+"""Sampling profiler for the server's threads, served as collapsed stacks.
+
+Set SMILEBOT_PROFILE=1 and GET /debug/profile?seconds=N. For N seconds
+the request's thread reads every other thread's current frame with
+sys._current_frames() SAMPLE_HZ times a second and counts each distinct
+stack, then returns one line per stack, root first, in the collapsed
+format flamegraph.pl and speedscope read:
+
+    motor-loop;run (threading.py);motor_control_loop (smilebot_core.py);step (smilebot_core.py) 41
+
+Stacks start with the thread's name, numbers dropped so all of Werkzeug's
+request threads fold together. Nothing runs between profiles: no thread,
+no hooks, no settrace, so leaving it enabled costs nothing until someone
+asks, and while one runs each sample holds the GIL for a few microseconds
+per thread. The table is bounded by MAX_STACKS, and one profile runs at a
+time.
+
+Every server's route hands ?seconds= to respond() and sends back what it
+returns. Only this process is sampled: with --motor-process the motor loop
+runs in a child, profile that with py-spy.
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+enabled = os.environ.get('SMILEBOT_PROFILE', '0') not in ('', '0', 'false')
+
+SAMPLE_HZ = 100
+MAX_SECONDS = 60.0
+MAX_STACKS = 5000  # distinct stacks kept, later new ones count as [truncated]
+MAX_DEPTH = 128  # frames kept per stack, innermost first
+
+_busy = threading.Lock()
+_labels = {}  # code object -> 'function (file)', grows with the code that runs
+
+def frame_label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = '%s (%s)' % (code.co_name, os.path.basename(code.co_filename))
+    return label
+
+def thread_label(name):
+    # 'Thread-12 (process_request_thread)' -> 'Thread (process_request_thread)'
+    return re.sub(r'-\d+', '', name).replace(';', ':')
+
+def collapse(frame):
+    labels = []
+    while frame is not None and len(labels) < MAX_DEPTH:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    if frame is not None:
+        labels.append('[deeper]')
+    labels.reverse()
+    return ';'.join(labels)
+
+def sample(seconds, hz=SAMPLE_HZ):
+    # Returns ({collapsed stack: count}, samples taken) for every thread
+    # but the calling one
+    skip = {threading.get_ident()}
+    counts = {}
+    samples = 0
+    interval = 1.0 / hz
+    deadline = time.monotonic() + seconds
+    next_sample = time.monotonic()
+    while next_sample < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        for ident, frame in frames.items():
+            if ident in skip:
+                continue
+            thread = thread_label(names.get(ident, 'unknown'))
+            stack = '%s;%s' % (thread, collapse(frame))
+            if stack not in counts and len(counts) >= MAX_STACKS:
+                stack = thread + ';[truncated]'
+            counts[stack] = counts.get(stack, 0) + 1
+        frames = frame = None  # don't keep other threads' locals alive while asleep
+        samples += 1
+        next_sample += interval
+        delay = next_sample - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_sample = time.monotonic()  # fell behind, don't burst
+    return counts, samples
+
+def profile(seconds, hz=SAMPLE_HZ):
+    # Samples from the calling thread for seconds (at most MAX_SECONDS) and
+    # returns the collapsed stacks as text, busiest first. Returns None if
+    # another profile is already running.
+    if not _busy.acquire(blocking=False):
+        return None
+    try:
+        counts, _ = sample(min(seconds, MAX_SECONDS), hz)
+    finally:
+        _busy.release()
+    lines = sorted(counts.items(), key=lambda item: -item[1])
+    return ''.join('%s %d\n' % line for line in lines)
+
+def parse_seconds(value, default=10.0):
+    # ?seconds= as a float, raises ValueError for junk
+    seconds = default if value in (None, '') else float(value)
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError('seconds must be over 0 and at most %g' % MAX_SECONDS)
+    return seconds
+
+def respond(seconds_arg):
+    # /debug/profile for any server: (status, content type, body) for the
+    # raw ?seconds= value. Blocks while sampling, so event loops run it in
+    # an executor.
+    if not enabled:
+        return 404, 'text/plain', 'Not Found'
+    try:
+        seconds = parse_seconds(seconds_arg)
+    except ValueError as e:
+        return 400, 'application/json', json.dumps({'error': str(e)})
+    stacks = profile(seconds)
+    if stacks is None:
+        return 503, 'text/plain', 'Busy'
+    return 200, 'text/plain', stacks
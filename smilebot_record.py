@@ -0,0 +1,205 @@
+"""Record joystick sessions to a compact binary log and replay them.
+
+Every command core accepts from /joystick, /joystick/batch, /ws or /arm is
+appended as one fixed width little endian record:
+
+    time     d  wall clock seconds
+    seq      Q  command sequence number
+    throttle h  raw stick value, -1 to 1 scaled to +-32767
+    steering h
+    flags    B  bit 0 armed, bit 1 set for an /arm change (sticks unused)
+    pad      x
+
+22 bytes a sample after an 8 byte file header. The log rotates like
+logging's RotatingFileHandler (session.bin, session.bin.1, ...), and the
+reader maps files with mmap and unpacks them with struct.iter_unpack.
+Sticks are stored before the dead zone so a replay through set_joystick
+shapes them exactly as the live run did.
+
+    python3 smilebot_control_v3.py --record session.bin
+    python3 smilebot_record.py dump session.bin
+    python3 smilebot_record.py replay session.bin --speed 4
+"""
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+MAGIC = b'SMBREC1\n'
+RECORD = struct.Struct('<dQhhBx')
+SCALE = 32767
+MAX_BYTES = 4 * 1024 * 1024  # per file, about 190k samples
+BACKUPS = 5
+FLUSH_INTERVAL = 1.0  # seconds, a crash loses at most this much
+
+ARMED = 1
+ARM_EVENT = 2
+
+Record = namedtuple('Record', 'time seq throttle steering armed arm_event')
+
+def quantize(value):
+    return int(round(max(-1.0, min(1.0, value)) * SCALE))
+
+class Recorder:
+    # Thread safe, core calls record() with its command lock held so the
+    # log is in the same order the commands were applied
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.last_flush = time.monotonic()
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write(MAGIC)
+            self.size = len(MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            older = '%s.%d' % (self.path, i)
+            if os.path.exists(older):
+                os.replace(older, '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def record(self, seq, throttle, steering, armed, arm_event=False):
+        data = RECORD.pack(time.time(), seq & 0xffffffffffffffff, quantize(throttle), quantize(steering),
+                           (ARMED if armed else 0) | (ARM_EVENT if arm_event else 0))
+        with self.lock:
+            if self.file is None:
+                return
+            if self.size + len(data) > self.max_bytes:
+                self.rotate()
+            self.file.write(data)
+            self.size += len(data)
+            now = time.monotonic()
+            if now - self.last_flush >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def session_files(path):
+    # Oldest first: path.N ... path.1, path
+    files = []
+    i = 1
+    while os.path.exists('%s.%d' % (path, i)):
+        files.append('%s.%d' % (path, i))
+        i += 1
+    files.reverse()
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def read_records(path):
+    # Yields the Records in one file. A torn record at the end, from a
+    # crash mid-write, is skipped. Raises ValueError for a foreign file.
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC:
+                raise ValueError('%s is not a smilebot recording' % path)
+            end = len(MAGIC) + (size - len(MAGIC)) // RECORD.size * RECORD.size
+            view = memoryview(m)[len(MAGIC):end]
+            try:
+                for t, seq, throttle, steering, flags in RECORD.iter_unpack(view):
+                    yield Record(t, seq, throttle / SCALE, steering / SCALE,
+                                 bool(flags & ARMED), bool(flags & ARM_EVENT))
+            finally:
+                view.release()
+
+def read_session(path):
+    for name in session_files(path):
+        yield from read_records(name)
+
+def read_array(path):
+    # The whole session as one numpy structured array with fields time,
+    # seq, throttle, steering (raw, unscaled) and flags, for offline analysis
+    import numpy as np
+    dtype = np.dtype([('time', '<f8'), ('seq', '<u8'), ('throttle', '<i2'), ('steering', '<i2'),
+                      ('flags', 'u1'), ('pad', 'V1')])
+    parts = []
+    for name in session_files(path):
+        with open(name, 'rb') as f:
+            data = f.read()
+        if len(data) < len(MAGIC):
+            continue
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a smilebot recording' % name)
+        count = (len(data) - len(MAGIC)) // dtype.itemsize
+        parts.append(np.frombuffer(data, dtype, count, len(MAGIC)))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype)
+
+def replay(records, speed=1.0, stop=None):
+    # Feeds records into core at their recorded pace divided by speed, or
+    # back to back with speed 0. Sequence numbers are renumbered by core so
+    # a replay is never rejected as stale against live commands. Returns
+    # the number of records applied.
+    import smilebot_core as core
+    stop = stop or threading.Event()
+    start = first = None
+    count = 0
+    for record in records:
+        if speed:
+            if start is None:
+                start, first = time.monotonic(), record.time
+            delay = start + (record.time - first) / speed - time.monotonic()
+            if delay > 0 and stop.wait(delay):
+                break
+        elif stop.is_set():
+            break
+        if record.arm_event:
+            core.set_armed(record.armed)
+        else:
+            core.set_joystick(record.throttle, record.steering)
+        count += 1
+    return count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Dump or replay a recorded joystick session")
+    parser.add_argument('command', choices=('dump', 'replay'))
+    parser.add_argument('path', help="the session log, rotated files are included")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay speed, 2 for twice as fast, 0 for as fast as possible")
+    args = parser.parse_args()
+    if args.command == 'dump':
+        for record in read_session(args.path):
+            if record.arm_event:
+                print('%.6f %d %s' % (record.time, record.seq,
+                                      'arm' if record.armed else 'disarm'))
+            else:
+                print('%.6f %d %+.4f %+.4f%s' % (record.time, record.seq, record.throttle,
+                                                 record.steering, '' if record.armed else ' (disarmed)'))
+    else:
+        import smilebot_core as core
+        core.init_motors()
+        motor_thread = threading.Thread(target=core.motor_control_loop, name='motor-loop', daemon=True)
+        motor_thread.start()
+        started = time.monotonic()
+        try:
+            count = replay(read_session(args.path), args.speed)
+            print("Replayed %d commands in %.3f s" % (count, time.monotonic() - started))
+        except KeyboardInterrupt:
+            print("\nReplay interrupted")
+        finally:
+            core.cleanup()
@@ -0,0 +1,121 @@
+"""Stick and motor shaping, compiled to lookup tables.
+
+Each stick axis runs through trim, dead zone, expo and rate, in that
+order. Each motor then gets a calibration curve: a minimum speed that
+gets it turning at all, and a gain to match a weaker motor to a stronger
+one. compile_shaping() evaluates every curve once at RESOLUTION points,
+so shaping a value while driving is a clamp and one tuple index.
+
+A config is a dict, all keys optional, defaulting to the old fixed 20%
+dead zone:
+
+    {"throttle": {"trim": 0.0, "dead_zone": 0.2, "expo": 0.0, "rate": 1.0},
+     "steering": {...},
+     "left": {"gain": 1.0, "min": 0.0},
+     "right": {...}}
+
+trim is where the stick rests when let go, subtracted before the dead
+zone. expo blends in a cubic, 0 linear to 1 fully cubic, for finer control
+near centre. rate scales the axis after that.
+"""
+import json
+
+RESOLUTION = 2001  # table entries over -1..1, odd so 0 has its own entry
+_HALF = (RESOLUTION - 1) / 2
+
+AXES = ('throttle', 'steering')
+MOTORS = ('left', 'right')
+AXIS_DEFAULTS = {'trim': 0.0, 'dead_zone': 0.2, 'expo': 0.0, 'rate': 1.0}
+MOTOR_DEFAULTS = {'gain': 1.0, 'min': 0.0}
+# Allowed range of every setting
+LIMITS = {'trim': (-0.5, 0.5), 'dead_zone': (0.0, 0.9), 'expo': (0.0, 1.0), 'rate': (0.0, 1.0),
+          'gain': (0.0, 1.0), 'min': (0.0, 0.9)}
+
+def apply_dead_zone(value, dead_zone):
+    if abs(value) < dead_zone:
+        return 0
+    return (value - dead_zone * (1 if value > 0 else -1)) / (1 - dead_zone)
+
+def clamp(value):
+    return max(-1.0, min(1.0, value))
+
+def axis_curve(trim, dead_zone, expo, rate):
+    def shape(x):
+        x = apply_dead_zone(clamp(x - trim), dead_zone)
+        x = (1 - expo) * x + expo * x ** 3
+        return clamp(x * rate)
+    return shape
+
+def motor_curve(gain, min):
+    def calibrate(x):
+        if x == 0:
+            return 0.0
+        return clamp((min + (1 - min) * abs(x)) * gain * (1 if x > 0 else -1))
+    return calibrate
+
+class Table:
+    __slots__ = ('values',)
+
+    def __init__(self, curve):
+        self.values = tuple(curve(i / _HALF - 1.0) for i in range(RESOLUTION))
+
+    def lookup(self, x):
+        # Nearest entry, raises ValueError for NaN
+        if x >= 1.0:
+            return self.values[-1]
+        if x <= -1.0:
+            return self.values[0]
+        return self.values[int((x + 1.0) * _HALF + 0.5)]
+
+    def lookup_array(self, x):
+        # lookup() over a numpy array, for offline analysis
+        import numpy as np
+        index = np.floor((np.clip(x, -1.0, 1.0) + 1.0) * _HALF + 0.5).astype(np.intp)
+        return np.asarray(self.values)[index]
+
+class Shaping:
+    # Compiled tables plus the config they came from. Never modified after
+    # compiling, swap in a new one instead, see core.set_shaping.
+    __slots__ = ('config', 'throttle', 'steering', 'left', 'right')
+
+    def __init__(self, config):
+        self.config = config
+        self.throttle = Table(axis_curve(**config['throttle']))
+        self.steering = Table(axis_curve(**config['steering']))
+        self.left = Table(motor_curve(**config['left']))
+        self.right = Table(motor_curve(**config['right']))
+
+def normalize(config):
+    # Fills in defaults and checks every value, returns a new dict.
+    # Raises ValueError naming the first bad setting.
+    if not isinstance(config, dict):
+        raise ValueError('shaping config must be an object')
+    unknown = set(config) - set(AXES) - set(MOTORS)
+    if unknown:
+        raise ValueError('unknown section %s' % ', '.join(sorted(unknown)))
+    result = {}
+    for names, defaults in ((AXES, AXIS_DEFAULTS), (MOTORS, MOTOR_DEFAULTS)):
+        for name in names:
+            section = config.get(name, {})
+            if not isinstance(section, dict):
+                raise ValueError('%s must be an object' % name)
+            unknown = set(section) - set(defaults)
+            if unknown:
+                raise ValueError('unknown %s setting %s' % (name, ', '.join(sorted(unknown))))
+            values = dict(defaults)
+            for key, value in section.items():
+                low, high = LIMITS[key]
+                if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                        or not low <= value <= high:
+                    raise ValueError('%s.%s must be a number from %g to %g' % (name, key, low, high))
+                values[key] = float(value)
+            result[name] = values
+    return result
+
+def compile_shaping(config=None):
+    return Shaping(normalize(config or {}))
+
+def read_config(path):
+    # Raises OSError or ValueError
+    with open(path) as f:
+        return normalize(json.load(f))
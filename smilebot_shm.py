@@ -0,0 +1,178 @@
+"""Run the motor loop in its own process, fed through shared memory.
+
+The web process writes commands and arm state into a small
+multiprocessing.shared_memory block guarded by a seqlock: the writer bumps
+a counter to odd, writes, and bumps it back to even; a reader retries until
+it sees the same even counter before and after its read. The motor process
+therefore never takes a lock the web side can hold, and it stops sharing a
+GIL with Flask, template rendering and JSON parsing. A second seqlocked
+area carries the loop statistics back for /metrics, a third the odometry
+pose for /pose.
+"""
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+import smilebot_core as core
+import smilebot_odometry as odometry
+
+COUNTER = struct.Struct('<I')
+# Control area at offset 0: counter, running, armed, then the command
+RUNNING_OFFSET = 4
+ARMED_OFFSET = 5
+COMMAND_OFFSET = 8
+CONTROL = struct.Struct('<I??2xddQd')
+FLAG = struct.Struct('<?')
+COMMAND = struct.Struct('<ddQd')  # throttle, steering, seq, received
+# Stats area: counter, then core.LoopStats fields
+STATS_OFFSET = 64
+STATS = struct.Struct('<I4xQQdddQdQdddd')
+STATS_FIELDS = struct.Struct('<QQdddQdQdddd')
+# Pose area: counter, then the loop's smilebot_odometry.Pose
+POSE_OFFSET = 192
+POSE = struct.Struct('<I4x7d')
+POSE_FIELDS = struct.Struct('<7d')
+SIZE = POSE_OFFSET + POSE.size
+
+class SharedControl:
+    # Same interface as core.LocalControl on the motor side, plus the
+    # write_* methods core uses to publish from the web side
+
+    def __init__(self, wake):
+        self.shm = shared_memory.SharedMemory(create=True, size=SIZE)
+        self.wake = wake  # multiprocessing.Event, set on every write
+        self.write_lock = threading.Lock()
+        CONTROL.pack_into(self.shm.buf, 0, 0, True, False, *core.current_command)
+        STATS.pack_into(self.shm.buf, STATS_OFFSET, 0, 0, 0, 0.0, 0.0, 0.0, 0, 0.0, 0, 0.0,
+                        0.0, 0.0, 0.0)
+        POSE.pack_into(self.shm.buf, POSE_OFFSET, 0, *odometry.ORIGIN)
+        self.reported_pose = None
+
+    # --- seqlock ---
+
+    def _write(self, base, fmt, offset, *values):
+        # Packed before the counter goes odd: if packing raises, the counter
+        # must not be left odd with readers spinning on it forever
+        data = fmt.pack(*values)
+        buf = self.shm.buf
+        count = COUNTER.unpack_from(buf, base)[0]
+        COUNTER.pack_into(buf, base, (count + 1) & 0xffffffff)
+        buf[offset:offset + len(data)] = data
+        COUNTER.pack_into(buf, base, (count + 2) & 0xffffffff)
+
+    def _read(self, base, fmt):
+        buf = self.shm.buf
+        while True:
+            values = fmt.unpack_from(buf, base)
+            if not values[0] & 1 and COUNTER.unpack_from(buf, base)[0] == values[0]:
+                return values
+            time.sleep(0)  # writer is mid-update, let it finish
+
+    # --- web process side ---
+
+    def write_command(self, command):
+        with self.write_lock:
+            self._write(0, COMMAND, COMMAND_OFFSET, *command)
+        self.wake.set()
+
+    def write_armed(self, armed):
+        with self.write_lock:
+            self._write(0, FLAG, ARMED_OFFSET, armed)
+        self.wake.set()
+
+    def write_running(self, running):
+        with self.write_lock:
+            self._write(0, FLAG, RUNNING_OFFSET, running)
+        self.wake.set()
+
+    def read_stats(self):
+        stats = core.LoopStats()
+        (_, stats.iterations, stats.pickups, stats.pickup_sum, stats.pickup_max,
+         stats.period_max, stats.overruns, stats.lateness_max, stats.steps,
+         stats.lateness_sum, stats.period_last, stats.left, stats.right) = self._read(STATS_OFFSET, STATS)
+        return stats
+
+    def read_pose(self):
+        return odometry.Pose(*self._read(POSE_OFFSET, POSE)[1:])
+
+    # --- motor process side ---
+
+    now = staticmethod(time.monotonic)
+
+    def read(self):
+        _, running, armed, throttle, steering, seq, received = self._read(0, CONTROL)
+        return running, armed, core.Command(throttle, steering, seq, received)
+
+    def clear(self):
+        self.wake.clear()
+
+    def wait(self, timeout):
+        self.wake.wait(timeout)
+
+    def report(self, stats):
+        # Only the motor process writes here, so no lock is needed
+        self._write(STATS_OFFSET, STATS_FIELDS, STATS_OFFSET + 8, stats.iterations,
+                    stats.pickups, stats.pickup_sum, stats.pickup_max, stats.period_max,
+                    stats.overruns, stats.lateness_max, stats.steps, stats.lateness_sum,
+                    stats.period_last, stats.left, stats.right)
+        pose = core.odometry.pose
+        if pose is not self.reported_pose:
+            self._write(POSE_OFFSET, POSE_FIELDS, POSE_OFFSET + 8, *pose)
+            self.reported_pose = pose
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+def raise_priority(priority):
+    # SCHED_FIFO needs root or CAP_SYS_NICE, fall back to a nice bump
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        print("Motor process running SCHED_FIFO priority %d" % priority)
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.nice(-10)
+        print("Motor process running at nice -10")
+    except OSError:
+        print("Could not raise motor process priority")
+
+def motor_process_main(control, priority):
+    if priority:
+        raise_priority(priority)
+    core.init_motors()
+    try:
+        core.motor_control_loop(control)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for motor in (core.left_motor, core.right_motor):
+            try:
+                motor.stop()
+            except Exception:
+                pass
+
+def start_motor_process(priority=0):
+    # Call before starting any threads: the child is forked so it inherits
+    # the shared memory mapping rather than attaching to it by name
+    ctx = multiprocessing.get_context('fork')
+    control = SharedControl(ctx.Event())
+    proc = ctx.Process(target=motor_process_main, args=(control, priority),
+                       name='motor-loop', daemon=True)
+    proc.start()
+    core.shared = control
+    return proc
+
+def stop_motor_process(proc, timeout=2.0):
+    control = core.shared
+    control.write_running(False)
+    proc.join(timeout)
+    if proc.is_alive():
+        proc.terminate()
+        proc.join()
+    core.shared = None
+    control.close(unlink=True)
@@ -0,0 +1,259 @@
+"""Headless drive backend: a simulated robot in virtual time.
+
+SimRobot carries two SimMotor objects with the forward/backward/stop/value
+interface of gpiozero.Motor, so they drop into core.left_motor and
+core.right_motor. Each motor follows its command with a first order lag
+(MOTOR_TIME_CONSTANT) and the robot integrates a differential drive pose
+from the wheel speeds.
+
+Time is a VirtualClock that only moves when something waits. SimControl
+gives core.motor_control_loop its commands and clock, so the loop runs
+unchanged, in lockstep with the simulation and without sleeping. An hour
+of driving takes seconds. The CLI's MotionEngine runs the same way through
+motion_engine().
+
+    python3 smilebot_sim.py --script program.txt
+    python3 smilebot_sim.py --session session.bin --speed 1
+    python3 smilebot_sim.py --soak 2
+"""
+import argparse
+import heapq
+import math
+import random
+import time
+import smilebot_core as core
+import smilebot_odometry
+from smilebot_motion import MotionEngine
+from smilebot_odometry import FULL_SPEED, TRACK_WIDTH
+
+MOTOR_TIME_CONSTANT = 0.1  # s to reach 63% of a new speed
+SIM_STEP = 0.005  # s, integration step while a wheel is still changing speed
+
+class VirtualClock:
+    # Callable like time.monotonic, advanced only by SimRobot.advance_to
+
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def __call__(self):
+        return self.time
+
+class SimMotor:
+    # Stand-in for gpiozero.Motor
+
+    def __init__(self, robot):
+        self.robot = robot
+        self.value = 0.0  # commanded speed, -1 to 1
+        self.speed = 0.0  # actual speed after the motor lag
+
+    def _set(self, value):
+        # The clock only moves in advance_to, so the robot is always up to
+        # date when a command lands
+        self.value = max(-1.0, min(1.0, value))
+
+    def forward(self, speed=1):
+        self._set(speed)
+
+    def backward(self, speed=1):
+        self._set(-speed)
+
+    def stop(self):
+        self._set(0.0)
+
+    @property
+    def is_active(self):
+        return self.value != 0
+
+class SimRobot:
+
+    def __init__(self, clock=None, full_speed=FULL_SPEED, track_width=TRACK_WIDTH,
+                 time_constant=MOTOR_TIME_CONSTANT):
+        self.clock = clock or VirtualClock()
+        self.full_speed = full_speed
+        self.track_width = track_width
+        self.time_constant = time_constant
+        self.left = SimMotor(self)
+        self.right = SimMotor(self)
+        self.x = self.y = self.heading = 0.0  # m, m, radians counterclockwise
+        self.distance = 0.0  # m travelled by the robot's centre
+        # What core would dead reckon from the commands alone, without the lag
+        self.odometry = smilebot_odometry.Odometry(self.clock, full_speed, track_width)
+
+    def install(self):
+        # Point core at the simulated motors and odometry, returns what to
+        # restore
+        previous = core.left_motor, core.right_motor, core.odometry
+        core.left_motor, core.right_motor, core.odometry = self.left, self.right, self.odometry
+        return previous
+
+    def restore(self, previous):
+        core.left_motor, core.right_motor, core.odometry = previous
+
+    def _settle(self, motor, dt):
+        if self.time_constant <= 0:
+            motor.speed = motor.value
+        else:
+            motor.speed = motor.value + (motor.speed - motor.value) * math.exp(-dt / self.time_constant)
+            if abs(motor.speed - motor.value) < 1e-6:
+                motor.speed = motor.value
+
+    def _move(self, left, right, dt):
+        v, w = smilebot_odometry.body_velocity(left, right, self.full_speed, self.track_width)
+        self.x, self.y, self.heading = smilebot_odometry.arc(self.x, self.y, self.heading, v, w, dt)
+        self.distance += abs(v) * dt
+
+    def advance_to(self, t):
+        now = self.clock.time
+        while now < t:
+            left, right = self.left, self.right
+            if left.speed == left.value and right.speed == right.value:
+                self._move(left.speed, right.speed, t - now)
+                now = t
+                break
+            dt = min(SIM_STEP, t - now)
+            start = left.speed, right.speed
+            self._settle(left, dt)
+            self._settle(right, dt)
+            self._move((start[0] + left.speed) / 2, (start[1] + right.speed) / 2, dt)
+            now += dt
+        self.clock.time = max(self.clock.time, t)
+
+    def sleep(self, timeout):
+        # MotionEngine wait hook: nothing can abort a virtual wait
+        self.advance_to(self.clock() + timeout)
+        return False
+
+    def pose(self):
+        return {'t': round(self.clock(), 6), 'x': round(self.x, 4), 'y': round(self.y, 4),
+                'heading': round(math.degrees(self.heading) % 360, 2),
+                'distance': round(self.distance, 4)}
+
+class SimControl:
+    # core.LocalControl for virtual time. events is a list of
+    # (time, 'j', (throttle, steering)) and (time, 'a', armed) tuples;
+    # the loop stops once the clock reaches until.
+
+    def __init__(self, robot, events, until):
+        self.robot = robot
+        self.events = [(t, i, kind, value) for i, (t, kind, value) in enumerate(events)]
+        heapq.heapify(self.events)
+        self.until = until
+        self.running = True
+        self.armed = False
+        self.command = core.Command(0.0, 0.0, 0, 0.0)
+
+    def now(self):
+        return self.robot.clock()
+
+    def read(self):
+        return self.running, self.armed, self.command
+
+    def clear(self):
+        pass
+
+    def report(self, stats):
+        pass
+
+    def wait(self, timeout):
+        target = min(self.now() + timeout, self.until)
+        woken = self.events and self.events[0][0] <= target
+        if woken:
+            target = max(self.now(), self.events[0][0])
+        self.robot.advance_to(target)
+        while self.events and self.events[0][0] <= target:
+            _, _, kind, value = heapq.heappop(self.events)
+            if kind == 'a':
+                self.armed = bool(value)
+            else:
+                throttle, steering = value
+                self.command = core.Command(*core.shape(throttle, steering),
+                                            self.command.seq + 1, target)
+        if not woken and target >= self.until:
+            self.running = False
+
+def run_loop(events, duration, robot=None):
+    # Runs core.motor_control_loop against the simulation for duration
+    # virtual seconds. Returns (robot, loop stats).
+    robot = robot or SimRobot()
+    control = SimControl(robot, events, robot.clock() + duration)
+    previous = robot.install()
+    previous_stats, core.loop_stats = core.loop_stats, core.LoopStats()
+    try:
+        core.motor_control_loop(control)
+        return robot, core.loop_stats
+    finally:
+        robot.restore(previous)
+        core.loop_stats = previous_stats
+
+def motion_engine(robot, drive=None):
+    # A MotionEngine that drives robot in virtual time, with
+    # smilebot_cli.drive unless another drive is given
+    if drive is None:
+        from smilebot_cli import drive
+    robot.install()
+    return MotionEngine(drive, clock=robot.clock, wait=robot.sleep)
+
+def session_events(records, speed=1.0):
+    # Events from a smilebot_record session, times relative to its start
+    events = []
+    first = None
+    for record in records:
+        if first is None:
+            first = record.time
+        t = (record.time - first) / speed
+        if record.arm_event:
+            events.append((t, 'a', record.armed))
+        else:
+            events.append((t, 'j', (record.throttle, record.steering)))
+    return events
+
+def soak_events(duration, rate=20.0, seed=0):
+    # A random walk on the stick at rate Hz with the odd disarm, for soaks
+    rng = random.Random(seed)
+    events = [(0.0, 'a', True)]
+    throttle = steering = 0.0
+    t = 0.0
+    while t < duration:
+        t += 1.0 / rate
+        throttle = max(-1.0, min(1.0, throttle + rng.uniform(-0.2, 0.2)))
+        steering = max(-1.0, min(1.0, steering + rng.uniform(-0.2, 0.2)))
+        events.append((t, 'j', (throttle, steering)))
+        if rng.random() < 0.001:
+            events.append((t, 'a', False))
+            events.append((t + 1.0, 'a', True))
+    return events
+
+def stats_dict(stats):
+    return {field: getattr(stats, field) for field in core.LoopStats.__slots__
+            if field != 'last_tick'}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drive a simulated robot in virtual time")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--script', metavar='FILE', help="run a CLI motion program")
+    group.add_argument('--session', metavar='FILE', help="run a smilebot_record session through the motor loop")
+    group.add_argument('--soak', type=float, metavar='HOURS', help="random driving through the motor loop")
+    parser.add_argument('--speed', type=float, default=1.0, help="session replay speed")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    if args.script:
+        from smilebot_motion import parse_program
+        with open(args.script) as f:
+            segments = parse_program(f)
+        robot = SimRobot()
+        motion_engine(robot).run(segments)
+        robot.sleep(1.0)  # let the wheels spin down
+        print('pose', robot.pose())
+    else:
+        if args.session:
+            import smilebot_record
+            events = session_events(smilebot_record.read_session(args.session), args.speed)
+            duration = (events[-1][0] if events else 0.0) + 1.0
+        else:
+            duration = args.soak * 3600
+            events = soak_events(duration)
+        robot, stats = run_loop(events, duration)
+        print('pose', robot.pose())
+        print('loop', stats_dict(stats))
+    print('odometry', smilebot_odometry.pose_dict(robot.odometry.estimate(robot.clock())))
+    print('simulated %.1f s in %.3f s' % (robot.clock(), time.perf_counter() - started))
@@ -0,0 +1,273 @@
+"""UDP control channel for gamepads and companion scripts.
+
+One datagram per command, no connection, so a lost packet costs nothing
+and never holds up the next one:
+
+    magic    2s  b'SB'
+    version  B   1
+    flags    B   bit 0 armed, bit 1 auth tag follows
+    seq      Q   command sequence, shared with the page, see set_joystick
+    sent     d   sender wall clock, seconds
+    throttle h   -1 to 1 scaled to +-32767, before the dead zone
+    steering h
+    tag      8s  optional, HMAC-SHA256 of everything before it, truncated
+
+UdpListener feeds packets into core.set_joystick and core.set_armed like
+/ws does. Packets that are malformed, fail auth, arrive behind a newer one
+from the same sender or later than LATE_AFTER past the fastest delivery
+seen are dropped and counted, and their arm flag is ignored. Gaps in seq
+are counted as lost. If nothing from the sender driving is accepted for
+FAILSAFE_TIMEOUT, its sticks are zeroed; dropped packets don't hold that
+off.
+
+    python3 smilebot_control_v3.py --udp 5005
+    python3 smilebot_udp.py 192.168.1.50:5005 --gamepad
+"""
+import argparse
+import hashlib
+import hmac
+import math
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+import smilebot_core as core
+import smilebot_metrics as metrics
+
+MAGIC = b'SB'
+VERSION = 1
+PACKET = struct.Struct('<2sBBQdhh')
+TAG_SIZE = 8
+SCALE = 32767
+ARMED = 1
+TAGGED = 2
+
+LATE_AFTER = 0.1  # seconds of delay beyond the best seen from that sender
+FAILSAFE_TIMEOUT = 0.5  # seconds without packets before a moving robot stops
+MAX_SENDERS = 64  # the least recently heard from are forgotten past this
+SEND_RATE = 50.0  # packets per second while the stick is off centre
+IDLE_RATE = 5.0  # packets per second while it is centred, as a keepalive
+
+packets_received = metrics.counter('smilebot_udp_packets_total', 'UDP control packets received')
+packets_dropped = {reason: metrics.counter('smilebot_udp_dropped_%s_total' % reason, help_text)
+                   for reason, help_text in (
+                       ('malformed', 'UDP packets dropped as malformed'),
+                       ('auth', 'UDP packets dropped for a missing or bad auth tag'),
+                       ('reordered', 'UDP packets dropped behind a newer one'),
+                       ('late', 'UDP packets dropped as late'))}
+packets_lost = metrics.counter('smilebot_udp_lost_total', 'UDP packets never received, from seq gaps')
+failsafe_stops = metrics.counter('smilebot_udp_failsafe_total', 'Stops after the UDP sender went quiet')
+packet_delay = metrics.histogram('smilebot_udp_delay_seconds',
+                                 'UDP packet delay beyond the fastest seen from its sender')
+
+def sign(key, data):
+    return hmac.new(key, data, hashlib.sha256).digest()[:TAG_SIZE]
+
+def encode(seq, throttle, steering, armed, key=None, sent=None):
+    flags = (ARMED if armed else 0) | (TAGGED if key else 0)
+    data = PACKET.pack(MAGIC, VERSION, flags, seq, time.time() if sent is None else sent,
+                       int(round(max(-1.0, min(1.0, throttle)) * SCALE)),
+                       int(round(max(-1.0, min(1.0, steering)) * SCALE)))
+    return data + sign(key, data) if key else data
+
+def decode(data, key=None):
+    # Returns (seq, sent, throttle, steering, armed). Raises ValueError for a
+    # malformed packet and PermissionError when auth fails.
+    if len(data) not in (PACKET.size, PACKET.size + TAG_SIZE):
+        raise ValueError('bad length %d' % len(data))
+    magic, version, flags, seq, sent, throttle, steering = PACKET.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a smilebot packet')
+    if not math.isfinite(sent):
+        raise ValueError('bad send time')
+    if not 0 < seq < core.MAX_SEQ:
+        raise ValueError('seq out of range')
+    tagged = bool(flags & TAGGED)
+    if tagged != (len(data) == PACKET.size + TAG_SIZE):
+        raise ValueError('tag flag does not match length')
+    if key is not None:
+        if not tagged or not hmac.compare_digest(sign(key, data[:PACKET.size]), data[PACKET.size:]):
+            raise PermissionError('bad auth tag')
+    return seq, sent, throttle / SCALE, steering / SCALE, bool(flags & ARMED)
+
+class SenderState:
+    __slots__ = ('seq', 'best_delay')
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.best_delay = None  # smallest arrival - sent, absorbs clock offset
+
+class UdpListener(threading.Thread):
+
+    def __init__(self, port, host='0.0.0.0', key=None):
+        super().__init__(name='udp-control', daemon=True)
+        self.key = key
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.senders = OrderedDict()  # address -> SenderState, least recent first
+        self.driver = None  # client whose last accepted command was off centre
+        self.last_accepted = 0.0  # monotonic time of the driver's last accepted packet
+
+    def stop(self):
+        self.sock.close()
+
+    def run(self):
+        while core.running:
+            now = time.monotonic()
+            wait = FAILSAFE_TIMEOUT
+            if self.driver is not None:
+                wait = self.last_accepted + FAILSAFE_TIMEOUT - now
+                if wait <= 0:
+                    # Sender died or lost its link with the stick held over.
+                    # Leaves the sticks alone if someone else has taken over.
+                    failsafe_stops.inc()
+                    core.release_client(self.driver)
+                    self.driver = None
+                    wait = FAILSAFE_TIMEOUT
+            try:
+                self.sock.settimeout(wait)
+                data, address = self.sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            except OSError:
+                break  # closed by stop()
+            self.handle(data, address, time.time())
+
+    def handle(self, data, address, arrival):
+        packets_received.inc()
+        try:
+            seq, sent, throttle, steering, armed = decode(data, self.key)
+        except PermissionError:
+            packets_dropped['auth'].inc()
+            return
+        except (ValueError, struct.error):
+            packets_dropped['malformed'].inc()
+            return
+        state = self.senders.get(address)
+        if state is None:
+            state = self.senders[address] = SenderState(seq - 1)
+            if len(self.senders) > MAX_SENDERS:
+                self.senders.popitem(last=False)
+        else:
+            self.senders.move_to_end(address)
+        if seq <= state.seq:
+            packets_dropped['reordered'].inc()
+            return
+        if seq > state.seq + 1:
+            packets_lost.inc(seq - state.seq - 1)
+        state.seq = seq
+        delay = arrival - sent
+        if state.best_delay is None or delay < state.best_delay:
+            state.best_delay = delay
+        if metrics.enabled:
+            packet_delay.observe(delay - state.best_delay)
+        if delay - state.best_delay > LATE_AFTER:
+            packets_dropped['late'].inc()
+            return
+        client = ('udp', address)
+        if not core.set_joystick(throttle, steering, seq, client=client):
+            return
+        if throttle != 0 or steering != 0:
+            self.driver = client
+            self.last_accepted = time.monotonic()
+        elif self.driver == client:
+            self.driver = None
+        if armed != core.motors_armed:
+            core.set_armed(armed)
+
+def load_key(path=None):
+    # Shared secret from a file or SMILEBOT_UDP_KEY, None for no auth
+    if path:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    key = os.environ.get('SMILEBOT_UDP_KEY')
+    return key.encode() if key else None
+
+# --- Reference sender ---
+
+def read_gamepad():
+    # Yields (throttle, steering, armed) from the first pygame joystick:
+    # left stick Y for throttle, right stick X for steering, A toggles arm
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    pygame.init()
+    pygame.joystick.init()
+    if not pygame.joystick.get_count():
+        sys.exit("No gamepad found")
+    pad = pygame.joystick.Joystick(0)
+    armed = False
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.JOYBUTTONDOWN and event.button == 0:
+                armed = not armed
+                print("Armed" if armed else "Disarmed")
+        # Stick up is negative, the same as the page's throttle
+        yield pad.get_axis(1), pad.get_axis(3 if pad.get_numaxes() > 3 else 0), armed
+
+def read_lines(stream):
+    # Yields (throttle, steering, armed) from 'throttle steering [0|1]' lines,
+    # holding the last values between lines
+    current = (0.0, 0.0, False)
+    lines = queue.Queue()
+    done = object()
+
+    def reader():
+        for line in stream:
+            lines.put(line)
+        lines.put(done)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        try:
+            while True:
+                line = lines.get_nowait()
+                if line is done:
+                    return
+                fields = line.split()
+                try:
+                    current = (float(fields[0]), float(fields[1]),
+                               len(fields) > 2 and fields[2] == '1')
+                except (IndexError, ValueError):
+                    print("expected 'throttle steering [armed]'", file=sys.stderr)
+        except queue.Empty:
+            pass
+        yield current
+
+def send(address, source, key=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Seeded from the clock like the page's seq, so the server never takes
+    # a restarted sender for a stale one
+    seq = int(time.time() * 1000)
+    next_send = time.monotonic()
+    armed = False
+    for throttle, steering, armed in source:
+        seq += 1
+        sock.sendto(encode(seq, throttle, steering, armed, key), address)
+        # Shaped as a default server would: a centred stick only needs keepalives
+        centred = core.shape(throttle, steering) == (0, 0)
+        next_send += 1.0 / (IDLE_RATE if centred else SEND_RATE)
+        delay = next_send - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_send = time.monotonic()
+    # Input ended, leave the robot centred rather than to the failsafe
+    sock.sendto(encode(seq + 1, 0.0, 0.0, armed, key), address)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reference UDP control sender")
+    parser.add_argument('address', help="robot host:port")
+    parser.add_argument('--gamepad', action='store_true',
+                        help="read a gamepad through pygame instead of stdin lines")
+    parser.add_argument('--key-file', help="shared secret, or set SMILEBOT_UDP_KEY")
+    args = parser.parse_args()
+    host, _, port = args.address.rpartition(':')
+    source = read_gamepad() if args.gamepad else read_lines(sys.stdin)
+    try:
+        send((host, int(port)), source, load_key(args.key_file))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,224 @@
+"""MJPEG camera stream for /video, sharing one capture thread.
+
+VideoService captures and encodes each frame once and publishes it to a
+FrameBuffer as a ready to send multipart chunk. Every viewer sends that
+same bytes object, and a slow viewer simply skips to whatever is newest,
+so nothing is copied, re-encoded or queued per client.
+
+Sources give JPEG bytes from read(quality):
+
+    SyntheticSource   moving test pattern, drawn with pygame, for testing
+    Picamera2Source   the Pi camera, through picamera2
+    OpenCVSource      a V4L2 / USB camera, through cv2
+
+The camera shares the Pi with the motor loop, so every ADAPT_INTERVAL the
+service looks at the loop's slew step lateness and how long new commands
+waited for it to wake, see core.loop_late. If the loop fell behind it
+halves the frame rate and drops JPEG quality, then creeps back up while
+the loop stays healthy.
+"""
+import threading
+import time
+import smilebot_core as core
+import smilebot_metrics as metrics
+
+BOUNDARY = 'frame'
+CONTENT_TYPE = 'multipart/x-mixed-replace; boundary=' + BOUNDARY
+
+VIDEO_FPS = 15
+VIDEO_QUALITY = 70
+MIN_FPS = 2
+MIN_QUALITY = 30
+ADAPT_INTERVAL = 1.0  # seconds between looks at the motor loop
+RECOVER_AFTER = 5  # healthy intervals before stepping back up
+
+class FrameBuffer:
+    # Latest frame as (id, multipart chunk). Waiters block on a condition;
+    # listeners are called from the capture thread, for event loops.
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame_id = 0
+        self.chunk = None
+        self.listeners = []
+
+    def publish(self, jpeg):
+        chunk = b''.join((b'--', BOUNDARY.encode(), b'\r\nContent-Type: image/jpeg\r\n',
+                          b'Content-Length: %d\r\n\r\n' % len(jpeg), jpeg, b'\r\n'))
+        with self.condition:
+            self.frame_id += 1
+            self.chunk = chunk
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def latest(self):
+        return self.frame_id, self.chunk
+
+    def wait(self, after_id, timeout=None):
+        # Returns the newest frame after after_id, or (after_id, None) on timeout
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frame_id != after_id, timeout):
+                return after_id, None
+            return self.frame_id, self.chunk
+
+# --- Sources ---
+
+class SyntheticSource:
+    # Diagonal bands that scroll, with a bar showing the left/right motor
+    # speeds, so lag and dropped frames are visible without a camera.
+    # Drawn and encoded with pygame, which can't set a JPEG quality, so
+    # quality below VIDEO_QUALITY shrinks the encoded frame instead: fewer
+    # bytes and less encoding, as a lower quality gives a real camera.
+
+    BAND = 16  # pixels, measured along x + y
+
+    def __init__(self, width=320, height=240):
+        import io
+        import pygame
+        self.io = io
+        self.pygame = pygame
+        self.width = width
+        self.height = height
+        self.frame = pygame.Surface((width, height))
+        # One band pair wider than the frame, blitted at a scrolling offset
+        period = 2 * self.BAND
+        self.bands = pygame.Surface((width + period, height))
+        self.bands.fill((64, 64, 64))
+        for x in range(0, width + period + height, period):
+            pygame.draw.polygon(self.bands, (160, 160, 160),
+                                [(x, 0), (x + self.BAND, 0),
+                                 (x + self.BAND - height, height), (x - height, height)])
+
+    def read(self, quality):
+        period = 2 * self.BAND
+        self.frame.blit(self.bands, (-(int(time.monotonic() * 60) % period), 0))
+        stats = core.read_loop_stats()
+        middle = self.width // 2
+        for row, speed in ((8, stats.left), (24, stats.right)):
+            end = middle + int(speed * (middle - 8))
+            self.frame.fill((255, 255, 255), (min(middle, end), row, abs(end - middle) + 1, 8))
+        frame = self.frame
+        scale = min(1.0, quality / VIDEO_QUALITY)
+        if scale < 1.0:
+            size = (max(8, int(self.width * scale)), max(8, int(self.height * scale)))
+            frame = self.pygame.transform.scale(frame, size)
+        buffer = self.io.BytesIO()
+        self.pygame.image.save(frame, buffer, 'frame.jpg')
+        return buffer.getvalue()
+
+    def close(self):
+        pass
+
+class Picamera2Source:
+
+    def __init__(self, width=640, height=480):
+        import io
+        from picamera2 import Picamera2
+        self.io = io
+        self.camera = Picamera2()
+        self.camera.configure(self.camera.create_video_configuration(main={'size': (width, height)}))
+        self.camera.start()
+
+    def read(self, quality):
+        self.camera.options['quality'] = quality
+        buffer = self.io.BytesIO()
+        self.camera.capture_file(buffer, format='jpeg')
+        return buffer.getvalue()
+
+    def close(self):
+        self.camera.stop()
+        self.camera.close()
+
+class OpenCVSource:
+
+    def __init__(self, device=0, width=640, height=480):
+        import cv2
+        self.cv2 = cv2
+        self.capture = cv2.VideoCapture(device)
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if not self.capture.isOpened():
+            raise RuntimeError('cannot open camera %r' % (device,))
+
+    def read(self, quality):
+        ok, frame = self.capture.read()
+        if not ok:
+            raise RuntimeError('camera read failed')
+        ok, jpeg = self.cv2.imencode('.jpg', frame, [self.cv2.IMWRITE_JPEG_QUALITY, quality])
+        return jpeg.tobytes()
+
+    def close(self):
+        self.capture.release()
+
+def open_source(spec):
+    # 'synthetic', 'picamera', or an OpenCV device number or path
+    if spec == 'synthetic':
+        return SyntheticSource()
+    if spec == 'picamera':
+        return Picamera2Source()
+    return OpenCVSource(int(spec) if spec.isdigit() else spec)
+
+# --- Capture thread ---
+
+class VideoService(threading.Thread):
+
+    def __init__(self, source, fps=VIDEO_FPS, quality=VIDEO_QUALITY):
+        super().__init__(name='video', daemon=True)
+        self.source = source
+        self.max_fps = self.fps = fps
+        self.max_quality = self.quality = quality
+        self.frames = FrameBuffer()
+        self.running = True
+        self.backoff = core.Backoff(RECOVER_AFTER)
+        self.last = None  # LoopStats counts at the last adapt
+        metrics.gauge('smilebot_video_fps', 'Video frame rate after adapting to the motor loop',
+                      lambda: self.fps)
+        metrics.gauge('smilebot_video_quality', 'Video JPEG quality after adapting to the motor loop',
+                      lambda: int(self.quality))
+
+    def stop(self):
+        self.running = False
+
+    def loop_degraded(self):
+        # True if the motor loop fell behind since last asked
+        stats = core.read_loop_stats()
+        counts = (stats.steps, stats.lateness_sum, stats.overruns, stats.pickups, stats.pickup_sum)
+        last, self.last = self.last, counts
+        if last is None:
+            return False
+        return core.loop_late(*(new - old for new, old in zip(counts, last)))
+
+    def adapt(self):
+        move = self.backoff.update(self.loop_degraded())
+        if move < 0:
+            self.fps = max(MIN_FPS, self.fps / 2)
+            self.quality = max(MIN_QUALITY, self.quality - 15)
+        elif move > 0:
+            self.fps = min(self.max_fps, self.fps + 1)
+            self.quality = min(self.max_quality, self.quality + 5)
+
+    def run(self):
+        next_frame = next_adapt = time.monotonic()
+        try:
+            while self.running:
+                now = time.monotonic()
+                if now >= next_adapt:
+                    self.adapt()
+                    next_adapt = now + ADAPT_INTERVAL
+                try:
+                    self.frames.publish(self.source.read(int(self.quality)))
+                except Exception as e:
+                    print(f"Video capture error: {e}")
+                    time.sleep(1.0)
+                # Fixed rate deadlines, skipping any frames we fell behind on
+                next_frame += 1.0 / self.fps
+                now = time.monotonic()
+                if next_frame < now:
+                    next_frame = now
+                time.sleep(next_frame - now)
+        finally:
+            self.source.close()
+
+    def settings(self):
+        return {'fps': round(self.fps, 1), 'quality': int(self.quality)}
@@ -0,0 +1,81 @@
+// Small static thumbstick served from the robot itself, so the control
+// page works on the robot's own hotspot without reaching a CDN. It follows
+// the slice of the nipplejs API the page used:
+//   Thumbstick.create({zone, color, size}).on('move' | 'end', fn)
+// 'move' handlers get (evt, {distance, angle: {radian}}) with the angle
+// counter-clockwise from the +x axis, 'end' fires when the thumb lifts.
+(function(global) {
+    function create(options) {
+        var zone = options.zone;
+        var size = options.size || 100;
+        var radius = size / 2;
+        var color = options.color || '#ffffff';
+        var handlers = {move: [], end: []};
+        var active = null;
+
+        var base = document.createElement('div');
+        base.style.cssText = 'position:absolute;left:50%;top:50%;border-radius:50%;opacity:0.35;' +
+            'width:' + size + 'px;height:' + size + 'px;margin:' + (-radius) + 'px 0 0 ' + (-radius) + 'px;' +
+            'background:' + color + ';';
+        var knob = document.createElement('div');
+        knob.style.cssText = 'position:absolute;left:50%;top:50%;border-radius:50%;opacity:0.85;' +
+            'width:' + radius + 'px;height:' + radius + 'px;margin:' + (-radius / 2) + 'px 0 0 ' + (-radius / 2) + 'px;' +
+            'background:' + color + ';pointer-events:none;';
+        zone.appendChild(base);
+        zone.appendChild(knob);
+        zone.style.touchAction = 'none';
+
+        function emit(name, data) {
+            for (var i = 0; i < handlers[name].length; i++) {
+                handlers[name][i]({type: name}, data);
+            }
+        }
+        function update(evt) {
+            var rect = base.getBoundingClientRect();
+            var dx = evt.clientX - (rect.left + radius);
+            var dy = evt.clientY - (rect.top + radius);
+            var distance = Math.min(Math.sqrt(dx * dx + dy * dy), radius);
+            var radian = Math.atan2(-dy, dx);
+            if (radian < 0) {
+                radian += 2 * Math.PI;
+            }
+            knob.style.transform = 'translate(' + (Math.cos(radian) * distance) + 'px,' +
+                (-Math.sin(radian) * distance) + 'px)';
+            emit('move', {distance: distance, angle: {radian: radian}});
+        }
+        function release(evt) {
+            if (evt.pointerId !== active) {
+                return;
+            }
+            active = null;
+            knob.style.transform = '';
+            emit('end');
+        }
+
+        zone.addEventListener('pointerdown', function(evt) {
+            if (active !== null) {
+                return;
+            }
+            active = evt.pointerId;
+            zone.setPointerCapture(active);
+            update(evt);
+            evt.preventDefault();
+        });
+        zone.addEventListener('pointermove', function(evt) {
+            if (evt.pointerId === active) {
+                update(evt);
+            }
+        });
+        zone.addEventListener('pointerup', release);
+        zone.addEventListener('pointercancel', release);
+
+        return {
+            on: function(name, fn) {
+                handlers[name].push(fn);
+                return this;
+            }
+        };
+    }
+
+    global.Thumbstick = {create: create};
+})(window);